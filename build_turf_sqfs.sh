@@ -35,6 +35,8 @@ PYTHON_SINGLE_FILES="pueo-utils/pysoceeprom/pysoceeprom.py \
 		tca9554/tca9554.py \
 		tca9554/turfcal.py \
 		rawpty/rawpty.py \
+		eventqueue/eventqueue.py \
+		hskframe/hskframe.py \
 		pueo-utils/HskSerial/HskSerial.py"
 
 # multi-file python modules wrapped in directories
@@ -0,0 +1,133 @@
+import os
+import sys
+import threading
+from collections import deque
+
+# Packet handoff between a reader thread and a selector loop.
+#
+# The old way was a queue.Queue plus one byte written to a self-pipe
+# per packet, and the selector callback would read one byte and pop
+# one packet. Under bursts that's a syscall pair and a trip through
+# select() for every single packet.
+#
+# Here the producer appends to a deque (appends/pops are atomic, no
+# lock needed) and only pokes the fd if the consumer hasn't been poked
+# yet. The consumer drains the fd in one read and takes everything
+# that's queued. Uses an eventfd if we have one (Python 3.10+),
+# otherwise a pipe.
+#
+# Single consumer only. The consumer must clear the signalled flag
+# BEFORE popping, otherwise a packet appended in between could be
+# left sitting there with nobody poking the fd.
+#
+# If the producer and consumer are the same thread, pass wakeup=False
+# and no fd gets created at all: put() just appends.
+#
+# With a maxsize, what happens when it's full depends on the policy:
+#   drop-newest : the new item is thrown away
+#   drop-oldest : the oldest queued item is thrown away
+#   block       : the producer waits for the consumer to drain. Can't
+#                 block yourself, so without a wakeup fd (or once
+#                 release() has been called) this acts like drop-newest.
+# put() returns how many items got dropped so the caller can count them:
+# with drop-oldest that's the one evicted and the new one always goes
+# in, otherwise it's the new one.
+class EventQueue:
+    POLICIES = ( 'drop-newest', 'drop-oldest', 'block' )
+    def __init__(self, maxsize=0, wakeup=True, policy='drop-newest'):
+        """
+        maxsize : maximum number of queued items (0 = unbounded)
+        wakeup : create an fd to wake up a selector (False if single-threaded)
+        policy : what to do when full (see above)
+        """
+        if policy not in self.POLICIES:
+            raise ValueError(f'unknown queue policy {policy}')
+        self.maxsize = maxsize
+        self.policy = policy
+        self._released = False
+        self._spaceCondition = threading.Condition()
+        self._queue = deque()
+        # without a wakeup fd we just pretend we're always signalled
+        self._signalled = not wakeup
+        self._wakeup = wakeup
+        if not wakeup:
+            self.rfd = None
+            self.wfd = None
+        elif hasattr(os, 'eventfd'):
+            self.rfd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+            self.wfd = self.rfd
+            self._token = (1).to_bytes(8, sys.byteorder)
+        else:
+            self.rfd, self.wfd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+            self._token = b'\x00'
+
+    def fileno(self):
+        return self.rfd
+
+    def __len__(self):
+        return len(self._queue)
+
+    def empty(self):
+        return not self._queue
+
+    def full(self):
+        return self.maxsize > 0 and len(self._queue) >= self.maxsize
+
+    def put(self, item):
+        """
+        queue item and wake up the consumer if it isn't already awake.
+        returns the number of items dropped (0 = nothing was).
+        """
+        dropped = 0
+        if self.maxsize and len(self._queue) >= self.maxsize:
+            if self.policy == 'drop-oldest':
+                try:
+                    self._queue.popleft()
+                    dropped = 1
+                except IndexError:
+                    pass
+            elif self.policy == 'block' and self._wakeup:
+                with self._spaceCondition:
+                    while len(self._queue) >= self.maxsize and not self._released:
+                        self._spaceCondition.wait(0.5)
+                if len(self._queue) >= self.maxsize:
+                    return 1
+            else:
+                return 1
+        self._queue.append(item)
+        if not self._signalled:
+            self._signalled = True
+            os.write(self.wfd, self._token)
+        return dropped
+
+    def drain(self):
+        """ clear the wakeup and return everything queued, oldest first """
+        if self._wakeup:
+            try:
+                os.read(self.rfd, 4096)
+            except BlockingIOError:
+                pass
+            self._signalled = False
+        items = []
+        while True:
+            try:
+                items.append(self._queue.popleft())
+            except IndexError:
+                break
+        if self.policy == 'block' and items:
+            with self._spaceCondition:
+                self._spaceCondition.notify_all()
+        return items
+
+    def release(self):
+        """ stop blocking producers (e.g. when shutting down) """
+        with self._spaceCondition:
+            self._released = True
+            self._spaceCondition.notify_all()
+
+    def close(self):
+        if not self._wakeup:
+            return
+        os.close(self.rfd)
+        if self.wfd != self.rfd:
+            os.close(self.wfd)
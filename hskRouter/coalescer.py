@@ -0,0 +1,151 @@
+# Request coalescing for the housekeeping router.
+#
+# All the upstreams poll the same SURFs for the same read-only stuff
+# (temps, volts, statistics...), and every copy takes its turn in the
+# TURFIO's stop-and-wait slot for that SURF. If an identical request
+# (destination, command, payload) is already on its way down, there's
+# no point sending another one: we just remember who else asked, and
+# when the response comes back each of them gets a copy with the
+# destination byte rewritten. The checksum only covers the data, so
+# the copies don't need a new one.
+#
+# Only commands listed as idempotent get coalesced, and only for a
+# short window after the first copy went down. A requester repeating
+# its own request (a retry, probably) isn't coalesced with itself.
+# Once someone's attached, the entry sticks around until the response
+# shows up or timeout runs out, and then they get an error response
+# instead of nothing.
+import logging
+import time
+
+class RequestCoalescer:
+    kErrorCmd = 0xFF
+    def __init__(self,
+                 commands=(),
+                 window=0.5,
+                 timeout=2.0,
+                 logName="testing",
+                 timeFn=time.monotonic):
+        """
+        commands : idempotent commands that can be coalesced
+        window : seconds after a request goes down that copies get attached
+        timeout : seconds to wait for the response before giving up on it
+        """
+        self.commands = set(commands)
+        self.window = window
+        self.timeout = timeout
+        self.logger = logging.getLogger(logName)
+        self.time = timeFn
+        # (dst, cmd, payload, leader) : entry dict with the leader
+        # (src, link), the time it went down, and the list of waiting
+        # (src, link)
+        self.inflight = {}
+        self.coalesced = 0
+        self.copies = 0
+        self.expired = 0
+
+    def _errors(self, k, e):
+        """ error responses for everyone waiting on entry e """
+        return [ (bytearray([k[0], src, self.kErrorCmd, 0, 0]), link)
+                 for src, link in e['waiters'] ]
+
+    def _expire(self, now):
+        """ forget what nobody can attach to anymore. Returns error copies for the ones that timed out """
+        errors = []
+        for k in list(self.inflight):
+            e = self.inflight[k]
+            age = now - e['sent']
+            if e['waiters'] and age > self.timeout:
+                self.logger.debug('coalesced request to %s timed out with %d waiting',
+                                  hex(k[0]), len(e['waiters']))
+                self.expired += len(e['waiters'])
+                errors += self._errors(k, e)
+                del self.inflight[k]
+            elif not e['waiters'] and age > self.window:
+                del self.inflight[k]
+        return errors
+
+    def attach(self, pkt, link):
+        """
+        If an identical request is in flight, remember pkt's sender (which
+        came in on link) and return True: pkt doesn't need to go down.
+        """
+        if pkt[2] not in self.commands:
+            return False
+        now = self.time()
+        req = (pkt[1], pkt[2], bytes(pkt[4:-1]))
+        who = (pkt[0], link)
+        e = None
+        for k, c in self.inflight.items():
+            if k[:3] != req or now - c['sent'] > self.window:
+                continue
+            if who == c['leader'] or who in c['waiters']:
+                return False
+            if e is None or c['sent'] > e['sent']:
+                e = c
+        if e is None:
+            return False
+        e['waiters'].append(who)
+        self.coalesced += 1
+        return True
+
+    def sent(self, pkt, link):
+        """ pkt from link went downstream: later copies can attach to it """
+        if pkt[2] not in self.commands:
+            return
+        leader = (pkt[0], link)
+        key = (pkt[1], pkt[2], bytes(pkt[4:-1]), leader)
+        if key in self.inflight:
+            # this was a retry
+            return
+        self.inflight[key] = { 'leader' : leader,
+                               'sent' : self.time(),
+                               'waiters' : [] }
+
+    def response(self, pkt):
+        """
+        pkt came back from downstream. Returns a list of (copy, link) for
+        everyone that was coalesced onto the request it answers.
+        """
+        if not self.inflight:
+            return []
+        # the response is from the request's destination, to the leader.
+        # if there's more than one match, the oldest one goes first
+        match = None
+        for k, e in self.inflight.items():
+            if (k[0] == pkt[0] and e['leader'][0] == pkt[1] and
+                (k[1] == pkt[2] or pkt[2] == self.kErrorCmd)):
+                if match is None or e['sent'] < self.inflight[match]['sent']:
+                    match = k
+        if match is None:
+            return []
+        e = self.inflight.pop(match)
+        copies = []
+        for src, link in e['waiters']:
+            rpkt = bytearray(pkt)
+            rpkt[1] = src
+            copies.append((rpkt, link))
+        self.copies += len(copies)
+        return copies
+
+    def poll(self):
+        """ returns (error copies for timed out requests, seconds until the next check or None) """
+        now = self.time()
+        errors = self._expire(now)
+        wake = min((e['sent'] + (self.timeout if e['waiters'] else self.window) - now
+                    for e in self.inflight.values()), default=None)
+        return errors, wake
+
+    def flush(self):
+        """ give up on everything, returns error copies for everyone waiting """
+        errors = []
+        for k, e in self.inflight.items():
+            errors += self._errors(k, e)
+        self.inflight = {}
+        return errors
+
+    def asDict(self):
+        return { 'inflight' : len(self.inflight),
+                 'coalesced' : self.coalesced,
+                 'copies' : self.copies,
+                 'expired' : self.expired }
@@ -0,0 +1,94 @@
+# Active SURF discovery for the housekeeping router.
+#
+# If the router doesn't know where a destination lives it has to
+# broadcast to every TURFIO, and then every one of those links sits
+# there waiting for a response that's only going to come from (at most)
+# one of them. Right after boot, with no KnownSources, that's everything.
+#
+# So at startup (and periodically after that) we ping every candidate
+# ID that doesn't have a route down every TURFIO link, using the
+# standard cmd 0 ping-pong with the router's own ID as the source.
+# Whoever answers gets learned by the link like any other packet. When
+# the sweep's over, anything that didn't answer is known to be absent,
+# and the router can send back an error immediately instead of
+# broadcasting. Absent IDs get pinged again on the next sweep, and
+# any packet heard from them brings them right back.
+import logging
+import time
+
+class DiscoverySweep:
+    kPingCmd = 0
+    def __init__(self,
+                 myID,
+                 links,
+                 routes,
+                 send,
+                 ids=range(0x40, 0x60),
+                 interval=60,
+                 timeout=2.0,
+                 logName="testing",
+                 timeFn=time.monotonic):
+        """
+        myID : source ID the router uses for its own packets
+        links : downstream links to sweep
+        routes : the downstream RouteTable
+        send : function(link, pkt) to send a packet out a link
+        ids : candidate IDs to look for
+        interval : seconds between sweeps (0 = only at startup)
+        timeout : seconds to wait for answers before calling an ID absent
+        """
+        self.myID = myID
+        self.links = links
+        self.routes = routes
+        self.send = send
+        self.ids = list(ids)
+        self.interval = interval
+        self.timeout = timeout
+        self.logger = logging.getLogger(logName)
+        self.time = timeFn
+        self.absent = set()
+        # IDs pinged in the current sweep, or None if not sweeping
+        self.candidates = None
+        self.deadline = None
+        # sweep right away
+        self.nextSweep = self.time()
+
+    def start(self):
+        """ ping every candidate ID that isn't routed yet """
+        now = self.time()
+        self.candidates = [ sid for sid in self.ids
+                            if not self.routes.lookup(sid) ]
+        self.deadline = now + self.timeout
+        self.nextSweep = now + self.interval if self.interval else None
+        self.logger.info("discovery: pinging %d IDs on %d links",
+                         len(self.candidates), len(self.links))
+        for sid in self.candidates:
+            pkt = bytes([self.myID, sid, self.kPingCmd, 0, 0])
+            for link in self.links:
+                self.send(link, pkt)
+
+    def finish(self):
+        """ anything we pinged that still has no route is absent """
+        self.absent = set( sid for sid in self.candidates
+                           if not self.routes.lookup(sid) )
+        found = len(self.candidates) - len(self.absent)
+        self.logger.info("discovery: found %d IDs, %d absent",
+                         found, len(self.absent))
+        self.candidates = None
+        self.deadline = None
+
+    def poll(self):
+        """ run the sweep state machine. returns seconds until it needs to run again, or None """
+        now = self.time()
+        if self.deadline is not None and now >= self.deadline:
+            self.finish()
+        if self.deadline is None and self.nextSweep is not None and now >= self.nextSweep:
+            self.start()
+        wake = [ t for t in (self.deadline, self.nextSweep) if t is not None ]
+        if not wake:
+            return None
+        return max(min(wake) - now, 0)
+
+    def isAbsent(self, sid):
+        """ True if sid didn't answer the last sweep and hasn't been heard since """
+        return sid in self.absent and not self.routes.lookup(sid)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+# Binary flight recorder for the housekeeping router.
+#
+# Logging every packet at INFO means hex-formatting it and pushing it
+# through journald, which is exactly what you can't afford when you're
+# debugging a load problem. Instead every routed packet goes into a
+# fixed-size ring of fixed-size slots in a memory-mapped file in /tmp.
+# Recording is a struct pack and a memcpy, so it stays on all the time.
+#
+# File layout (little-endian):
+#   header  : magic, version, slot count, slot size, records written,
+#             wall clock and monotonic time when the ring was created,
+#             then MAX_LINKS link names (8 bytes each, NUL padded)
+#   slots   : monotonic time, ingress link index, egress link bitmask,
+#             packet length, packet bytes (truncated to fit)
+#
+# Run this file to dump/filter a ring after the fact. The router also
+# dumps its ring as text on SIGUSR1.
+import argparse
+import mmap
+import os
+import struct
+import sys
+import time
+
+MAGIC = b'HSKFR\x00\x00\x00'
+VERSION = 1
+MAX_LINKS = 16
+NO_LINK = 0xFF
+
+HEADER = struct.Struct('<8sIIIQdd')
+NAME = struct.Struct('8s')
+HEADER_SIZE = 256
+# where the record count lives, so we can update just that
+COUNT_OFFSET = 20
+SLOT_HEADER = struct.Struct('<dBHH')
+# 4 header bytes + 255 data + checksum, rounded up
+SLOT_SIZE = 288
+MAX_PACKET = SLOT_SIZE - SLOT_HEADER.size
+
+class FlightRecorder:
+    def __init__(self, path, linkNames, slots=4096):
+        """
+        path : file to map (any previous one is kept as path.prev)
+        linkNames : names of the links, in link index order
+        slots : number of packets to keep
+        """
+        if len(linkNames) > MAX_LINKS:
+            raise ValueError(f'at most {MAX_LINKS} links can be recorded')
+        self.path = path
+        self.linkNames = list(linkNames)
+        self.slots = slots
+        self.count = 0
+        if os.path.exists(path):
+            os.replace(path, path + '.prev')
+        size = HEADER_SIZE + slots*SLOT_SIZE
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, slots, SLOT_SIZE, 0,
+                         time.time(), time.monotonic())
+        for i, nm in enumerate(self.linkNames):
+            NAME.pack_into(self.mm, HEADER.size + i*NAME.size, nm.encode())
+
+    def setLinkName(self, index, name):
+        """ name (or rename) link index """
+        if index >= MAX_LINKS:
+            raise ValueError(f'at most {MAX_LINKS} links can be recorded')
+        while len(self.linkNames) <= index:
+            self.linkNames.append('')
+        self.linkNames[index] = name
+        NAME.pack_into(self.mm, HEADER.size + index*NAME.size, name.encode())
+
+    def record(self, ingress, egressMask, pkt):
+        """ record pkt, which came in on link index ingress and went out on egressMask """
+        off = HEADER_SIZE + (self.count % self.slots)*SLOT_SIZE
+        n = min(len(pkt), MAX_PACKET)
+        SLOT_HEADER.pack_into(self.mm, off, time.monotonic(), ingress, egressMask, n)
+        off += SLOT_HEADER.size
+        self.mm[off:off+n] = pkt[:n]
+        self.count += 1
+        struct.pack_into('<Q', self.mm, COUNT_OFFSET, self.count)
+
+    def close(self):
+        self.mm.close()
+
+class FlightRecord:
+    def __init__(self, seq, timestamp, ingress, egressMask, pkt):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.ingress = ingress
+        self.egressMask = egressMask
+        self.pkt = pkt
+
+def readRing(buf):
+    """ parse a ring (bytes-like). returns (link names, wall-monotonic offset, records oldest first) """
+    magic, version, slots, slotSize, count, wall, mono = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not a flight recorder file')
+    names = []
+    for i in range(MAX_LINKS):
+        nm = NAME.unpack_from(buf, HEADER.size + i*NAME.size)[0].rstrip(b'\x00')
+        names.append(nm.decode())
+    records = []
+    for seq in range(max(0, count-slots), count):
+        off = HEADER_SIZE + (seq % slots)*slotSize
+        t, ingress, egress, n = SLOT_HEADER.unpack_from(buf, off)
+        off += SLOT_HEADER.size
+        records.append(FlightRecord(seq, t, ingress, egress, bytes(buf[off:off+n])))
+    return names, wall - mono, records
+
+def formatRecord(r, names, offset):
+    """ one line of text for record r """
+    def nm(i):
+        return names[i] if i < len(names) and names[i] else f'#{i}'
+    t = time.strftime('%H:%M:%S', time.localtime(r.timestamp + offset))
+    t += f'{(r.timestamp + offset) % 1:.6f}'[1:]
+    ingress = '-' if r.ingress == NO_LINK else nm(r.ingress)
+    egress = ','.join(nm(i) for i in range(MAX_LINKS) if r.egressMask & (1<<i))
+    return f'{r.seq:8d} {t} {ingress:>7s} -> {egress or "(dropped)":<15s} {r.pkt.hex(sep=" ")}'
+
+def dumpRing(buf, link=None, src=None, dst=None, cmd=None, last=None):
+    """ return the (filtered) contents of a ring as lines of text """
+    names, offset, records = readRing(buf)
+    if link is not None:
+        li = names.index(link)
+        records = [ r for r in records
+                    if r.ingress == li or r.egressMask & (1<<li) ]
+    if src is not None:
+        records = [ r for r in records if len(r.pkt) > 0 and r.pkt[0] == src ]
+    if dst is not None:
+        records = [ r for r in records if len(r.pkt) > 1 and r.pkt[1] == dst ]
+    if cmd is not None:
+        records = [ r for r in records if len(r.pkt) > 2 and r.pkt[2] == cmd ]
+    if last is not None:
+        records = records[-last:]
+    return [ formatRecord(r, names, offset) for r in records ]
+
+if __name__ == "__main__":
+    anyint = lambda x : int(x, 0)
+    parser = argparse.ArgumentParser(description="Dump the hskRouter flight recorder ring.")
+    parser.add_argument("path", nargs='?', default="/tmp/hskRouter.ring", help="ring file")
+    parser.add_argument("--link", help="only packets in or out of this link (e.g. TURFIO2)")
+    parser.add_argument("--src", type=anyint, help="only packets from this ID")
+    parser.add_argument("--dst", type=anyint, help="only packets to this ID")
+    parser.add_argument("--cmd", type=anyint, help="only packets with this command")
+    parser.add_argument("--last", type=int, help="only the last N matching packets")
+
+    args = parser.parse_args()
+    try:
+        with open(args.path, 'rb') as f:
+            buf = f.read()
+        for l in dumpRing(buf, args.link, args.src, args.dst, args.cmd, args.last):
+            print(l)
+    except Exception as e:
+        print(f'Exception: {repr(e)}', file=sys.stderr)
+        exit(1)
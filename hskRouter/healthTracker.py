@@ -0,0 +1,153 @@
+# Circuit breakers for downstream links and destinations.
+#
+# A TURFIO held in reset or an unpowered SURF still costs a full
+# timeout for every packet sent its way, and a broadcast costs that on
+# every link. So we count consecutive timeouts for every link and every
+# destination ID. After threshold of them in a row the target is
+# marked down, and the router answers requests for it with an error
+# right away instead of sending them.
+#
+# Every probe interval (doubling each time it stays down, up to a
+# maximum) a down target is due for a probe: the router pings it, and
+# any response at all brings it back up. It keeps its probe interval
+# until it answers something that wasn't the router's own, so one that
+# goes right back down waits longer for its next probe (flapping backs
+# off). A link with nothing to ping goes half-open instead: it's let
+# back up, but one more timeout puts it straight back down with the
+# longer interval. A destination's route can age out while it's down,
+# so its breaker remembers the link it was last seen on and that's
+# where the probes go.
+import logging
+import time
+
+class Breaker:
+    def __init__(self):
+        self.failures = 0
+        self.down = False
+        # probe interval while down, kept after coming back up until
+        # a real success so flapping backs off
+        self.interval = None
+        self.nextProbe = None
+        # a probe is out and hasn't come back
+        self.probing = False
+        # for a destination, the link it last timed out on
+        self.link = None
+
+class HealthTracker:
+    def __init__(self,
+                 threshold=3,
+                 probeInterval=1.0,
+                 maxProbeInterval=30.0,
+                 logName="testing",
+                 timeFn=time.monotonic):
+        """
+        threshold : consecutive timeouts before a target is down
+        probeInterval : seconds before the first probe of a down target
+        maxProbeInterval : cap for the doubling probe interval
+        """
+        self.threshold = threshold
+        self.probeInterval = probeInterval
+        self.maxProbeInterval = maxProbeInterval
+        self.logger = logging.getLogger(logName)
+        self.time = timeFn
+        # targets are links or destination IDs
+        self.breakers = {}
+
+    @staticmethod
+    def name(target):
+        return getattr(target, 'name', None) or f'{target:#04x}'
+
+    def success(self, link, sid, probe=False):
+        """
+        got a packet from sid on link. probe = it was for the router
+        itself, which brings it back up but keeps the backoff around
+        """
+        for target in (link, sid):
+            b = self.breakers.get(target)
+            if b is None:
+                continue
+            if b.down:
+                self.logger.warning("%s is back up", self.name(target))
+            if probe and b.interval is not None:
+                b.down = False
+                b.failures = 0
+                b.nextProbe = None
+                b.probing = False
+            else:
+                del self.breakers[target]
+
+    def timeout(self, link, sid):
+        """ a request to sid on link timed out. link None = only count it against sid """
+        now = self.time()
+        for target in (link, sid):
+            if target is None:
+                continue
+            b = self.breakers.get(target)
+            if b is None:
+                b = Breaker()
+                self.breakers[target] = b
+            if target == sid and link is not None:
+                b.link = link
+            b.failures += 1
+            if b.down:
+                # a probe didn't make it (only back off once per probe,
+                # a link can see several time out)
+                if b.probing:
+                    b.probing = False
+                    self._backoff(b, now)
+            elif b.failures >= self.threshold:
+                b.down = True
+                self._backoff(b, now)
+                self.logger.warning("%s is down after %d timeouts, next probe in %.1f s",
+                                    self.name(target), b.failures, b.interval)
+
+    def _backoff(self, b, now):
+        if b.interval is None:
+            b.interval = self.probeInterval
+        else:
+            b.interval = min(b.interval*2, self.maxProbeInterval)
+        b.nextProbe = now + b.interval
+
+    def isDown(self, target):
+        b = self.breakers.get(target)
+        return b is not None and b.down
+
+    def lastLink(self, sid):
+        """ the link sid last timed out on, or None """
+        b = self.breakers.get(sid)
+        return None if b is None else b.link
+
+    def halfOpen(self, target):
+        """ let target back up on probation: the next timeout takes it down again """
+        b = self.breakers.get(target)
+        if b is None:
+            return
+        b.down = False
+        b.failures = self.threshold - 1
+        b.nextProbe = None
+        b.probing = False
+
+    def poll(self):
+        """ returns (targets due for a probe, seconds until the next one or None) """
+        now = self.time()
+        due = []
+        wake = None
+        for target, b in self.breakers.items():
+            if not b.down or b.nextProbe is None:
+                continue
+            if now >= b.nextProbe:
+                due.append(target)
+                # wait for the probe to time out before trying again
+                b.nextProbe = now + b.interval
+                b.probing = True
+            t = b.nextProbe - now
+            if wake is None or t < wake:
+                wake = t
+        return due, wake
+
+    def asDict(self):
+        now = self.time()
+        return { self.name(t) : { 'down' : b.down,
+                                  'failures' : b.failures,
+                                  'nextProbe' : None if b.nextProbe is None else b.nextProbe - now }
+                 for t, b in self.breakers.items() }
@@ -8,41 +8,122 @@ import struct
 import selectors
 import signal
 import logging
-import queue
+import socket
+import json
 import configparser
+from collections import deque
 from rawpty import RawPTY
+from eventqueue import EventQueue
 from signalhandler import SignalHandler
 
 # automagic
 sys.path.append(os.path.dirname(__file__))
 from turfSerHandler import SerHandler
+from routeTable import RouteTable
+from flightRecorder import FlightRecorder, dumpRing, NO_LINK
+from discovery import DiscoverySweep
+from coalescer import RequestCoalescer
+from telemetryPoller import TelemetryPoller
+from pendingTable import PendingTable
+import snapshot
+from healthTracker import HealthTracker
+from scatterGather import ScatterGather
+from linkStatistics import LinkStatistics, RttHistogram
 
 LOG_NAME = "hskRouter"
 DEFAULT_CONFIG_NAME = "/usr/local/pylib/hskRouter/hskRouter.ini"
 CONFIG_NAME="/usr/local/share/hskRouter.ini"
 
-# configy stuff. just set up the dicts
-config = {}
-for i in range(4):
-    config['TURFIO'+str(i)] = {}
-
-nm = DEFAULT_CONFIG_NAME
-if os.path.exists(CONFIG_NAME):
-    nm = CONFIG_NAME
-    
-if os.path.exists(nm):
+# configy stuff. this gets called again on SIGHUP
+def loadConfig(nm):
+    config = {}
+    for i in range(4):
+        config['TURFIO'+str(i)] = {}
+    if not os.path.exists(nm):
+        return config
     parser = configparser.ConfigParser(converters={'list': lambda x: [i.strip() for i in x.split(',')] if len(x) > 0 else []})
     parser.read(nm)
     config['LogLevel'] = parser.getint('hskRouter', 'LogLevel', fallback=30)
     config['Upstreams'] = parser.getlist('hskRouter', 'Upstreams', fallback=["HSK0", "HSK1", "SFC", "LOCAL"])
     config['DownstreamTimeout'] = parser.getfloat('hskRouter', 'DownstreamTimeout', fallback=0.1)
+    config['DownstreamMinTimeout'] = parser.getfloat('hskRouter', 'DownstreamMinTimeout', fallback=0.02)
+    # per-command fixed timeouts, cmd = seconds
+    config['Timeouts'] = {}
+    if parser.has_section('Timeouts'):
+        for k, v in parser['Timeouts'].items():
+            config['Timeouts'][int(k, 0)] = float(v)
+    config['DownstreamWindow'] = parser.getint('hskRouter', 'DownstreamWindow', fallback=4)
+    config['Engine'] = parser.get('hskRouter', 'Engine', fallback='thread')
     config['TurfSource'] = int(parser.get('hskRouter', 'TurfSource', fallback='0x60'), 0)
+    config['RouterSource'] = int(parser.get('hskRouter', 'RouterSource', fallback='0x61'), 0)
     config['TurfPath'] = parser.get('hskRouter', 'TurfPath', fallback='/dev/hskturf')
     config['LocalPath'] = parser.get('hskRouter', 'LocalPath', fallback='/dev/hsklocal')
+    config['RouteMaxAge'] = parser.getfloat('hskRouter', 'RouteMaxAge', fallback=60.0)
+    config['UpstreamRouteMaxAge'] = parser.getfloat('hskRouter', 'UpstreamRouteMaxAge', fallback=0)
+    config['PendingTimeout'] = parser.getfloat('hskRouter', 'PendingTimeout', fallback=2.0)
+    config['SnapshotPath'] = parser.get('hskRouter', 'SnapshotPath', fallback='/tmp/hskRouter.snap')
+    config['SnapshotInterval'] = parser.getfloat('hskRouter', 'SnapshotInterval', fallback=10.0)
+    config['RouteDumpPath'] = parser.get('hskRouter', 'RouteDumpPath', fallback='/tmp/hskRouter.routes')
+    config['RecorderPath'] = parser.get('hskRouter', 'RecorderPath', fallback='/tmp/hskRouter.ring')
+    config['RecorderSlots'] = parser.getint('hskRouter', 'RecorderSlots', fallback=4096)
+    config['RecorderDumpPath'] = parser.get('hskRouter', 'RecorderDumpPath', fallback='/tmp/hskRouter.ring.txt')
+    config['StatsPath'] = parser.get('hskRouter', 'StatsPath', fallback='/tmp/hskRouter.stats')
+    config['DiscoveryFirst'] = int(parser.get('Discovery', 'First', fallback='0x40'), 0)
+    config['DiscoveryLast'] = int(parser.get('Discovery', 'Last', fallback='0x5F'), 0)
+    config['DiscoveryInterval'] = parser.getfloat('Discovery', 'Interval', fallback=60.0)
+    config['DiscoveryTimeout'] = parser.getfloat('Discovery', 'Timeout', fallback=2.0)
+    config['DiscoveryEnable'] = parser.getboolean('Discovery', 'Enable', fallback=True)
+    config['CoalesceEnable'] = parser.getboolean('Coalesce', 'Enable', fallback=False)
+    config['CoalesceWindow'] = parser.getfloat('Coalesce', 'Window', fallback=0.5)
+    config['CoalesceCommands'] = list(map(lambda x : int(x, 0),
+                                          parser.getlist('Coalesce', 'Commands', fallback=['0', '15', '16', '17', '18'])))
+    config['PollerEnable'] = parser.getboolean('Poller', 'Enable', fallback=False)
+    config['PollerMaxAge'] = parser.getfloat('Poller', 'MaxAge', fallback=2.0)
+    # cmd:interval
+    config['PollerCommands'] = {}
+    for c in parser.getlist('Poller', 'Commands', fallback=['16:1.0', '17:1.0']):
+        cmd, interval = c.split(':')
+        config['PollerCommands'][int(cmd, 0)] = float(interval)
+    config['HealthEnable'] = parser.getboolean('Health', 'Enable', fallback=False)
+    config['HealthThreshold'] = parser.getint('Health', 'Threshold', fallback=3)
+    config['HealthProbeInterval'] = parser.getfloat('Health', 'ProbeInterval', fallback=1.0)
+    config['HealthMaxProbeInterval'] = parser.getfloat('Health', 'MaxProbeInterval', fallback=30.0)
+    config['GatherTimeout'] = parser.getfloat('Gather', 'Timeout', fallback=0.5)
+    # where the serial ports live
+    config['Ports'] = { 'HSK0' : '/dev/ttySC0',
+                        'HSK1' : '/dev/ttySC1',
+                        'SFC' : '/dev/hskspi' }
+    for i in range(4):
+        config['Ports']['TURFIO'+str(i)] = '/dev/ttyUL'+str(i)
+    if parser.has_section('Ports'):
+        for k, v in parser['Ports'].items():
+            config['Ports'][k.upper()] = v
+    # queue bounds and what to do when they fill up
+    config['FifoSize'] = parser.getint('Queues', 'FifoSize', fallback=256)
+    config['FifoPolicy'] = parser.get('Queues', 'FifoPolicy', fallback='block')
+    config['LinkQueueSize'] = parser.getint('Queues', 'LinkQueueSize', fallback=64)
+    config['LinkQueuePolicy'] = parser.get('Queues', 'LinkQueuePolicy', fallback='block')
+    config['RouterQueueSize'] = parser.getint('Queues', 'RouterQueueSize', fallback=1024)
+    config['RouterQueuePolicy'] = parser.get('Queues', 'RouterQueuePolicy', fallback='drop-newest')
+    # weights for sharing the downstreams among the upstreams.
+    # ROUTER is stuff the router sends itself.
+    config['Weights'] = { 'HSK0' : 4, 'HSK1' : 4, 'SFC' : 1, 'LOCAL' : 2, 'ROUTER' : 1 }
+    if parser.has_section('Weights'):
+        for k, v in parser['Weights'].items():
+            config['Weights'][k.upper()] = int(v)
     for i in range(4):
         link = 'TURFIO'+str(i)
         config[link]['KnownSources'] = list(map(lambda x : int(x, 0),
                                                 parser.getlist(link, 'KnownSources', fallback=[])))
+    return config
+
+configName = DEFAULT_CONFIG_NAME
+if os.path.exists(CONFIG_NAME):
+    configName = CONFIG_NAME
+# or whatever's on the command line (e.g. the bench)
+if len(sys.argv) > 1:
+    configName = sys.argv[1]
+config = loadConfig(configName)
 
 # https://stackoverflow.com/questions/45455898/polling-for-a-maximum-wait-time-unless-condition-in-python-2-7
 def wait_condition(condition, timeout=5.0, granularity=0.3, time_factory=time):
@@ -86,10 +167,10 @@ logger = logging.getLogger(LOG_NAME)
 logging.basicConfig(level=config['LogLevel'])
 
 # wait a moment for hskspi to show up
-if not wait_condition(lambda : os.path.exists('/dev/hskspi'),
-                      timeout=1.0,
-                      granularity=0.1):
-    logger.error('/dev/hskspi did not show up - exiting!!')
+if 'SFC' in config['Upstreams'] and not wait_condition(lambda : os.path.exists(config['Ports']['SFC']),
+                                                       timeout=1.0,
+                                                       granularity=0.1):
+    logger.error('%s did not show up - exiting!!', config['Ports']['SFC'])
     exit(1)
 
 turfpty = RawPTY(config['TurfPath'])
@@ -99,58 +180,99 @@ localpty = RawPTY(config['LocalPath'])
 sel = selectors.DefaultSelector()
 handler = SignalHandler(sel)
 
+# routing tables. downstream IDs (SURFs, TURF) live behind exactly
+# one link, upstream IDs can show up on several.
+downstreamRoutes = RouteTable('downstream',
+                              maxAge=config['RouteMaxAge'])
+upstreamRoutes = RouteTable('upstream',
+                            maxAge=config['UpstreamRouteMaxAge'],
+                            exclusive=False)
+
+# SIGUSR1 dumps the routing tables and the flight recorder,
+# SIGHUP reloads the config. Signal handlers can't touch the logger
+# safely, so use the self-pipe trick to get back into the main loop.
+sigRfd, sigWfd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+SIGNAL_CODES = { signal.SIGUSR1 : 0, signal.SIGHUP : 1 }
+def requestSignal(signum, frame):
+    os.write(sigWfd, bytes([SIGNAL_CODES[signum]]))
+for signum in SIGNAL_CODES:
+    signal.signal(signum, requestSignal)
+
+# the reload waits until we're done with this round of events: it can
+# close links that still have events sitting in the list
+reloadPending = False
+def handleSignals(fd, mask):
+    global reloadPending
+    codes = set(os.read(fd, 64))
+    if SIGNAL_CODES[signal.SIGHUP] in codes:
+        reloadPending = True
+    if SIGNAL_CODES[signal.SIGUSR1] in codes:
+        dumpState()
+
+def dumpState():
+    lines = upstreamRoutes.dump() + downstreamRoutes.dump()
+    with open(config['RouteDumpPath'], 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    logger.info("dumped routing tables to %s", config['RouteDumpPath'])
+    if recorder:
+        with open(config['RecorderDumpPath'], 'w') as f:
+            f.write('\n'.join(dumpRing(recorder.mm)) + '\n')
+        logger.info("dumped flight recorder to %s", config['RecorderDumpPath'])
+sel.register(sigRfd, selectors.EVENT_READ, handleSignals)
+
 # let's collect our upstream/downstream interfaces
 upstreams = []
 downstreams = []
 
-# create an upstream-to-downstream FIFO
-packetsForDownstream = queue.Queue()
+# create an upstream-to-downstream FIFO. these hold (packet, ingress link)
+# and only the main thread touches them, so no wakeups.
+packetsForDownstream = EventQueue(config['RouterQueueSize'],
+                                  wakeup=False,
+                                  policy=config['RouterQueuePolicy'])
 # create a downstream-to-upstream FIFO
-packetsForUpstream = queue.Queue()
+packetsForUpstream = EventQueue(config['RouterQueueSize'],
+                                wakeup=False,
+                                policy=config['RouterQueuePolicy'])
     
 # create the handlers. We added the name parameter to just
 # make things a bit easier to factor and debug
 
-# true serial upstreams
-for i in range(2):
-    nm="HSK"+str(i)
-    if nm in config['Upstreams']:
-        upstreams.append( SerHandler(sel,
-                                     name=nm,
-                                     logName=LOG_NAME,
-                                     port='/dev/ttySC'+str(i),
-                                     baud=460800) )
-        
-# ethernet upstream fakey serial
-if 'SFC' in config['Upstreams']:
-    upstreams.append( SerHandler(sel,
-                                 name="SFC",
-                                 logName=LOG_NAME,
-                                 port='/dev/hskspi') )
-# local fake upstream
-if 'LOCAL' in config['Upstreams']:
-    lh = SerHandler(sel,
-                    name="LOCAL",
+# upstream links by name. these can come and go on a reload
+UPSTREAM_NAMES = ( 'HSK0', 'HSK1', 'SFC', 'LOCAL' )
+def makeUpstream(nm):
+    # LOCAL is a fake upstream on a pty, the rest are
+    # true serial (HSKx) or ethernet upstream fakey serial (SFC)
+    uh = SerHandler(sel,
+                    name=nm,
                     logName=LOG_NAME,
-                    port=None)
-    localpty.serial_attach(lh.port)
-    upstreams.append(lh)
+                    routes=upstreamRoutes,
+                    engine=config['Engine'],
+                    fifoSize=config['FifoSize'],
+                    fifoPolicy=config['FifoPolicy'],
+                    port=None if nm == 'LOCAL' else config['Ports'][nm],
+                    baud=460800)
+    if nm == 'LOCAL':
+        localpty.serial_attach(uh.port)
+    return uh
+
+for nm in UPSTREAM_NAMES:
+    if nm in config['Upstreams']:
+        upstreams.append(makeUpstream(nm))
 
 # make an upstream handler factory function
 # see e.g. https://eev.ee/blog/2011/04/24/gotcha-python-scoping-closures/
 def makeUpstreamHandler(uph):
     def upstreamHandler(fd, mask):
-        if uph.fifo.empty():
-            logger.error("%s handler called but FIFO is empty?", uph.name)
-            raise IOError("empty fifo read")            
-        pktNo = os.read(fd, 1)
-        pkt = uph.fifo.get()
-        packetsForDownstream.put(pkt)
-        logger.info("got upstream packet #%d from %s via %s: %s",
-                    pktNo[0],
-                    hex(pkt[0]),
-                    uph.name,
-                    pkt.hex(sep=' '))
+        # one wakeup can cover a whole burst of packets
+        for pkt in uph.fifo.drain():
+            dropped = packetsForDownstream.put((pkt, uph))
+            if dropped:
+                uph.stats.add('dropped', dropped)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("got upstream packet from %s via %s: %s",
+                            hex(pkt[0]),
+                            uph.name,
+                            pkt.hex(sep=' '))
     return upstreamHandler
 
 # true serial downstreams
@@ -160,7 +282,18 @@ for i in range(4):
                                    logName=LOG_NAME,
                                    downstream=True,
                                    knownSources=config['TURFIO'+str(i)]['KnownSources'],
-                                   port='/dev/ttyUL'+str(i),
+                                   routes=downstreamRoutes,
+                                   engine=config['Engine'],
+                                   fifoSize=config['FifoSize'],
+                                   fifoPolicy=config['FifoPolicy'],
+                                   window=config['DownstreamWindow'],
+                                   timeout=config['DownstreamTimeout'],
+                                   minTimeout=config['DownstreamMinTimeout'],
+                                   commandTimeouts=config['Timeouts'],
+                                   weights=config['Weights'],
+                                   queueSize=config['LinkQueueSize'],
+                                   queuePolicy=config['LinkQueuePolicy'],
+                                   port=config['Ports']['TURFIO'+str(i)],
                                    baud=500000) )
 # and add the fake TURF pty
 th = SerHandler( sel,
@@ -168,27 +301,631 @@ th = SerHandler( sel,
                  logName=LOG_NAME,
                  downstream=True,
                  knownSources=[config['TurfSource']],
+                 routes=downstreamRoutes,
+                 timeout=config['DownstreamTimeout'],
+                 minTimeout=config['DownstreamMinTimeout'],
+                 commandTimeouts=config['Timeouts'],
+                 weights=config['Weights'],
+                 queueSize=config['LinkQueueSize'],
+                 queuePolicy=config['LinkQueuePolicy'],
+                 engine=config['Engine'],
+                 fifoSize=config['FifoSize'],
+                 fifoPolicy=config['FifoPolicy'],
                  port=None)
 turfpty.serial_attach(th.port)
 downstreams.append(th)
 
+# flight recorder. links are recorded by index, and a set of
+# links is a bitmask of those
+links = upstreams + downstreams
+linkIndex = { l : i for i, l in enumerate(links) }
+def linkMask(ls):
+    m = 0
+    for l in ls:
+        m |= 1 << linkIndex[l]
+    return m
+
+recorder = None
+if config['RecorderSlots']:
+    recorder = FlightRecorder(config['RecorderPath'],
+                              [ l.name for l in links ],
+                              slots=config['RecorderSlots'])
+
+##########################################################################
+# WARM START
+#
+# learned routes and counters get saved every SnapshotInterval and on
+# the way out, and loaded back at startup
+def saveSnapshot():
+    if not config['SnapshotPath']:
+        return
+    try:
+        snapshot.write(config['SnapshotPath'],
+                       snapshot.pack(links, (downstreamRoutes, upstreamRoutes)))
+    except OSError as e:
+        logger.error("could not write snapshot %s: %s", config['SnapshotPath'], repr(e))
+
+def loadSnapshot():
+    path = config['SnapshotPath']
+    if not path or not os.path.exists(path):
+        return
+    try:
+        wall, counters, routes = snapshot.unpack(snapshot.read(path),
+                                                 LinkStatistics.COUNTERS)
+    except (OSError, ValueError) as e:
+        logger.warning("ignoring snapshot %s: %s", path, repr(e))
+        return
+    # routes kept aging while we were down
+    downtime = max(time.time() - wall, 0)
+    byName = { l.name : l for l in links }
+    for nm, c in counters.items():
+        if nm in byName:
+            byName[nm].stats.restore(c)
+    tables = (downstreamRoutes, upstreamRoutes)
+    n = 0
+    for t, sid, nm, age in routes:
+        if t >= len(tables) or nm not in byName:
+            continue
+        table = tables[t]
+        age += downtime
+        if table.maxAge and age > table.maxAge:
+            continue
+        # static routes from the config win
+        if table.exclusive and table.lookup(sid):
+            continue
+        table.learn(sid, byName[nm], age)
+        n += 1
+    logger.info("warm start: %d routes from a snapshot %.1f seconds old", n, downtime)
+
+nextSnapshot = time.monotonic() + config['SnapshotInterval']
+def snapshotPoll():
+    global nextSnapshot
+    if not config['SnapshotPath'] or not config['SnapshotInterval']:
+        return None
+    now = time.monotonic()
+    if now >= nextSnapshot:
+        saveSnapshot()
+        nextSnapshot = now + config['SnapshotInterval']
+    return nextSnapshot - now
+
+loadSnapshot()
+###########################################################################
+
+# Nothing waits on the router's own packets (polls, probes, discovery,
+# scatter-gather), so if its queue on a link is full they're dropped
+# rather than stacking up forever under the block policy. Whoever sent
+# it sees a missing response, same as a timeout.
+def routerSend(link, pkt):
+    """ send a packet the router made up itself. False if it got dropped """
+    if not link.canAccept('ROUTER'):
+        link.stats.add('dropped')
+        return False
+    link.sendPacket(pkt, 'ROUTER')
+    if recorder:
+        recorder.record(NO_LINK, linkMask((link,)), pkt)
+    return True
+
+def errorResponse(pkt):
+    """ error response to pkt, as if it came from its destination """
+    return bytes([pkt[1], pkt[0], 0xFF, 0, 0])
+
+def routerResponse(pkt, cmd, data):
+    """ response from the router to the sender of pkt """
+    rpkt = bytearray([config['RouterSource'], pkt[0], cmd, len(data)])
+    rpkt += data
+    rpkt.append((256 - sum(data)) & 0xFF)
+    return rpkt
+
+##########################################################################
+# ROUTER STATISTICS
+#
+# Over housekeeping, addressed to RouterSource, cmd 15:
+#   no data : every link's counters as 32-bit values, in link order
+#   [link index] : that link's 64-bit counters and RTT histogram
+#   [0xFF, id] : id, then the RTT histogram for that destination
+# The Unix socket at StatsPath sends everything as JSON on connect.
+def eStatistics(pkt, ingress):
+    d = pkt[4:-1]
+    if not len(d):
+        fmt = ">%dI" % len(LinkStatistics.COUNTERS)
+        data = b''.join(struct.pack(fmt, *(min(v, 0xFFFFFFFF) for v in l.stats.values()))
+                        for l in links)
+    elif d[0] < len(links):
+        data = links[d[0]].stats.pack()
+    elif d[0] == 0xFF and len(d) > 1:
+        h = RttHistogram()
+        for l in links:
+            h.merge(l.stats.dstHistogram(d[1]))
+        data = bytes([d[1]]) + h.pack()
+    else:
+        routerSend(ingress, errorResponse(pkt))
+        return
+    routerSend(ingress, routerResponse(pkt, 15, data))
+
+def statisticsDict():
+    return { 'links' : { l.name : l.stats.asDict() for l in links },
+             'linkOrder' : [ l.name for l in links ],
+             'queueDepths' : { l.name : l.queueDepths() for l in downstreams },
+             'rto' : { l.name : { f'{d:#04x}' : e for d, e in sorted(l.rtoEstimates().items()) }
+                       for l in downstreams },
+             'pending' : pending.asDict(),
+             'health' : health.asDict() if health else None,
+             'coalescer' : coalescer.asDict() if coalescer else None,
+             'cache' : poller.cache.asDict() if poller else None }
+
+statsServer = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+if os.path.exists(config['StatsPath']):
+    os.unlink(config['StatsPath'])
+statsServer.bind(config['StatsPath'])
+statsServer.listen()
+statsServer.setblocking(False)
+def statsQuery(f, mask):
+    try:
+        client, address = statsServer.accept()
+    except BlockingIOError:
+        return
+    with client:
+        try:
+            client.settimeout(0.2)
+            client.sendall(json.dumps(statisticsDict()).encode())
+        except Exception as e:
+            logger.info('stats client exception %s', repr(e))
+sel.register(statsServer, selectors.EVENT_READ, statsQuery)
+
+##########################################################################
+# SCATTER-GATHER
+#
+# Over housekeeping, addressed to RouterSource, cmd 30:
+#   [target, cmd, payload...] : send cmd to every SURF routed behind
+#   TURFIO target (0xFF = all of them) and send back everyone's
+#   answers packed together. See scatterGather.py for the format.
+def eScatter(pkt, ingress):
+    d = pkt[4:-1]
+    if len(d) < 2 or not (d[0] < 4 or d[0] == 0xFF):
+        routerSend(ingress, errorResponse(pkt))
+        return
+    outs = downstreams[:4] if d[0] == 0xFF else downstreams[d[0]:d[0]+1]
+    ids = discoveryIds()
+    targets = [ (dh, sid) for dh in outs
+                for sid in downstreamRoutes.sources(dh) if sid in ids ]
+    down = set()
+    if health:
+        down = { sid for dh, sid in targets
+                 if health.isDown(dh) or health.isDown(sid) }
+    g = gather.start(pkt, ingress, d[1], d[2:], targets, down)
+    if g:
+        gatherDone(g)
+
+def gatherDone(g):
+    if g.ingress not in upstreams:
+        # went away in a reload
+        return
+    for data in g.pack():
+        routerSend(g.ingress, routerResponse(g.request, 30, data))
+
+def gatherPoll():
+    expired, wake = gather.poll()
+    for g in expired:
+        gatherDone(g)
+    return wake
+
+gather = ScatterGather(config['RouterSource'],
+                       routerSend,
+                       timeout=config['GatherTimeout'])
+
+# housekeeping commands addressed to the router itself
+routerCommands = {
+    15 : eStatistics,
+    30 : eScatter
+}
+###########################################################################
+
+# circuit breakers for dead links and SURFs
+def makeHealth():
+    return HealthTracker(threshold=config['HealthThreshold'],
+                         probeInterval=config['HealthProbeInterval'],
+                         maxProbeInterval=config['HealthMaxProbeInterval'],
+                         logName=LOG_NAME)
+health = None
+if config['HealthEnable']:
+    health = makeHealth()
+
+# which upstream each forwarded request came in on
+pending = PendingTable(config['PendingTimeout'])
+
+def discoveryIds():
+    return range(config['DiscoveryFirst'], config['DiscoveryLast']+1)
+
+# identical read-only requests from different upstreams share one trip
+def makeCoalescer():
+    return RequestCoalescer(config['CoalesceCommands'],
+                            window=config['CoalesceWindow'],
+                            timeout=config['PendingTimeout'],
+                            logName=LOG_NAME)
+coalescer = None
+if config['CoalesceEnable']:
+    coalescer = makeCoalescer()
+
+# the telemetry poller polls everything it has a route to
+def makePoller():
+    return TelemetryPoller(config['RouterSource'],
+                           downstreamRoutes,
+                           routerSend,
+                           config['PollerCommands'],
+                           ids=discoveryIds(),
+                           maxAge=config['PollerMaxAge'],
+                           logName=LOG_NAME)
+poller = None
+if config['PollerEnable'] and config['PollerCommands']:
+    poller = makePoller()
+
+# SURF discovery sweeps down the TURFIOs, not the TURF pty.
+def makeDiscovery():
+    return DiscoverySweep(config['RouterSource'],
+                          downstreams[:4],
+                          downstreamRoutes,
+                          routerSend,
+                          ids=discoveryIds(),
+                          interval=config['DiscoveryInterval'],
+                          timeout=config['DiscoveryTimeout'],
+                          logName=LOG_NAME)
+discovery = None
+if config['DiscoveryEnable']:
+    discovery = makeDiscovery()
+
+##########################################################################
+# ROUTING
+#
+def routeDownstream(pkt, ingress):
+    """
+    Route a packet that came in on an upstream. Returns False if it
+    can't go yet because a downstream it needs is backed up.
+    """
+    if pkt[1] == config['RouterSource']:
+        cb = routerCommands.get(pkt[2])
+        if cb:
+            cb(pkt, ingress)
+        else:
+            routerSend(ingress, errorResponse(pkt))
+        if recorder:
+            recorder.record(linkIndex[ingress], 0, pkt)
+        return True
+    rpkt = poller.answer(pkt) if poller else None
+    if rpkt:
+        routerSend(ingress, rpkt)
+        if recorder:
+            recorder.record(linkIndex[ingress], 0, pkt)
+        return True
+    outs = downstreamRoutes.lookup(pkt[1])
+    broadcast = False
+    if not outs and discovery and discovery.isAbsent(pkt[1]):
+        # nobody's there: tell them right away instead of broadcasting
+        logger.debug('%s is absent, rejecting', hex(pkt[1]))
+        routerSend(ingress, errorResponse(pkt))
+    elif not outs:
+        outs = downstreams
+        broadcast = True
+    if outs and health:
+        # fail fast instead of waiting out a timeout on something dead
+        if health.isDown(pkt[1]):
+            outs = ()
+        else:
+            outs = tuple(dh for dh in outs if not health.isDown(dh))
+        if not outs:
+            logger.debug('%s is down, rejecting', hex(pkt[1]))
+            routerSend(ingress, errorResponse(pkt))
+    if outs and coalescer and coalescer.attach(pkt, ingress):
+        # someone else already asked, they'll share the response
+        logger.debug('coalesced request from %s to %s', hex(pkt[0]), hex(pkt[1]))
+        if recorder:
+            recorder.record(linkIndex[ingress], 0, pkt)
+        return True
+    if config['LinkQueuePolicy'] == 'block':
+        for dh in outs:
+            if not dh.canAccept(ingress.name):
+                return False
+    for dh in outs:
+        if broadcast:
+            dh.stats.add('broadcasts')
+        dh.sendPacket(pkt, ingress.name)
+    if outs:
+        pending.add(pkt, ingress)
+    if outs and coalescer:
+        coalescer.sent(pkt, ingress)
+    if recorder:
+        recorder.record(linkIndex[ingress], linkMask(outs), pkt)
+    return True
+
+def routeUpstream(pkt, ingress):
+    """ Route a packet that came in on a downstream. """
+    dst = pkt[1]
+    if health:
+        health.success(ingress, pkt[0], probe=(dst == config['RouterSource']))
+    if dst == config['RouterSource']:
+        # it's for us, we just needed the route (and maybe the data)
+        if poller:
+            poller.response(pkt)
+        for g in gather.response(pkt):
+            gatherDone(g)
+        if recorder:
+            recorder.record(linkIndex[ingress], 0, pkt)
+        return
+    # responses go back where the request came from,
+    # everything else goes wherever dst has been seen
+    uh = pending.match(pkt)
+    if uh in upstreams:
+        outs = (uh,)
+    else:
+        logger.info('trying to find an upstream for destination %s', hex(dst))
+        outs = upstreamRoutes.lookup(dst)
+    for uh in outs:
+        logger.info('forwarding packet to %s', uh.name)
+        uh.sendPacket(pkt)
+    if recorder:
+        recorder.record(linkIndex[ingress], linkMask(outs), pkt)
+    if coalescer:
+        sendCopies(coalescer.response(pkt), ingress)
+
+def sendCopies(copies, ingress=None):
+    """ coalesced responses (or errors) to everyone who was waiting """
+    for rpkt, uh in copies:
+        if uh not in upstreams:
+            continue
+        logger.info('copying coalesced response to %s via %s', hex(rpkt[1]), uh.name)
+        uh.sendPacket(rpkt)
+        if recorder:
+            recorder.record(linkIndex[ingress] if ingress else NO_LINK, linkMask((uh,)), rpkt)
+
+def coalescerPoll():
+    expired, wake = coalescer.poll()
+    sendCopies(expired)
+    return wake
+
+# HEALTH: timeouts only count against a link and destination if the
+# destination is actually routed there. Otherwise every broadcast and
+# discovery ping would count against every link that doesn't have it.
+# A down destination's route ages out, but its probes still go to the
+# link it was last on and those timeouts still count against it (just
+# not the link), so its probe interval keeps backing off.
+def checkTimeouts():
+    for dh in downstreams:
+        for dst in dh.drainTimeouts():
+            if not health:
+                continue
+            if dh in downstreamRoutes.lookup(dst):
+                health.timeout(dh, dst)
+            elif health.isDown(dst) and health.lastLink(dst) is dh:
+                health.timeout(None, dst)
+
+def healthPoll():
+    due, wake = health.poll()
+    for target in due:
+        if target in downstreams:
+            # ping something we know is behind it
+            sids = downstreamRoutes.sources(target)
+            if sids:
+                routerSend(target, bytes([config['RouterSource'], sids[0], 0, 0, 0]))
+            else:
+                health.halfOpen(target)
+        else:
+            outs = downstreamRoutes.lookup(target)
+            if not outs:
+                last = health.lastLink(target)
+                outs = (last,) if last in downstreams else ()
+            if not outs:
+                # nowhere to send it (the link's gone in a reload)
+                health.halfOpen(target)
+            for dh in outs:
+                routerSend(dh, bytes([config['RouterSource'], target, 0, 0, 0]))
+    return wake
+
+# BACKPRESSURE: if a downstream's queue for an upstream is full we
+# hold that upstream's packets here (in order) and stop reading it.
+# Its receive FIFO fills up next, and with the block policy that
+# stalls its reader, so the serial port itself backs up.
+stalled = {}
+def forwardDownstream(pkt, ingress):
+    if ingress not in upstreams:
+        # went away in a reload
+        return
+    if ingress in stalled:
+        stalled[ingress].append(pkt)
+        return
+    if not routeDownstream(pkt, ingress):
+        logger.debug('%s is backed up, pausing it', ingress.name)
+        stalled[ingress] = deque([pkt])
+        ingress.pause()
+
+def retryStalled():
+    for ingress in list(stalled):
+        q = stalled[ingress]
+        while q and routeDownstream(q[0], ingress):
+            q.popleft()
+        if not q:
+            logger.debug('%s is flowing again', ingress.name)
+            del stalled[ingress]
+            ingress.resume()
+
+def stalledPoll():
+    # the writer threads don't wake us up when they make room
+    return 0.01 if stalled else None
+###########################################################################
+
+# things the main loop needs to come back and service.
+# each returns the number of seconds until it needs it, or None
+def buildPollers():
+    p = [ dh.poll for dh in downstreams ]
+    p.append(stalledPoll)
+    p.append(snapshotPoll)
+    p.append(gatherPoll)
+    if health:
+        p.append(healthPoll)
+    if coalescer:
+        p.append(coalescerPoll)
+    if discovery:
+        p.append(discovery.poll)
+    if poller:
+        p.append(poller.poll)
+    return p
+pollers = buildPollers()
+
 # make a downstream handler factory function
 # see e.g. https://eev.ee/blog/2011/04/24/gotcha-python-scoping-closures/
 def makeDownstreamHandler(downh):
     def downstreamHandler(fd, mask):
-        if downh.fifo.empty():
-            logger.error("%s handler called but FIFO is empty?", downh.name)
-            return
-        pktNo = os.read(fd, 1)
-        pkt = downh.fifo.get()
-        packetsForUpstream.put(pkt)
-        logger.info("got downstream packet #%d from %s via %s: %s",
-                    pktNo[0],
-                    hex(pkt[0]),
-                    downh.name,
-                    pkt.hex(sep=' '))
+        for pkt in downh.fifo.drain():
+            dropped = packetsForUpstream.put((pkt, downh))
+            if dropped:
+                downh.stats.add('dropped', dropped)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("got downstream packet from %s via %s: %s",
+                            hex(pkt[0]),
+                            downh.name,
+                            pkt.hex(sep=' '))
     return downstreamHandler
 
+##########################################################################
+# RELOAD
+#
+# SIGHUP re-reads the ini and applies whatever changed in place.
+# Routes, knobs and the optional bits (coalescer, poller, discovery)
+# just get updated. Upstreams that got added or removed (or moved to
+# a different port) get started or stopped. Every other link keeps
+# running and keeps what it's learned. A few things are baked in at
+# startup and need a restart.
+RESTART_KEYS = ( 'Engine', 'TurfSource', 'RouterSource', 'TurfPath',
+                 'LocalPath', 'RecorderPath', 'RecorderSlots', 'StatsPath',
+                 'FifoPolicy', 'LinkQueuePolicy', 'RouterQueuePolicy' )
+def reloadConfig():
+    global coalescer, poller, discovery, health, pollers
+    # a broken ini shouldn't take down a running router. loadConfig()
+    # quietly uses the defaults for a file it can't read, so check first
+    try:
+        open(configName).close()
+        new = loadConfig(configName)
+    except (ValueError, KeyError, configparser.Error, OSError) as e:
+        logger.error("reload: can't load %s (%r), keeping the running config", configName, e)
+        return
+    changed = sorted(k for k in set(config) | set(new)
+                     if config.get(k) != new.get(k))
+    if not changed:
+        logger.info("reload: nothing changed")
+        return
+    logger.info("reload: changed %s", ', '.join(changed))
+    for k in RESTART_KEYS:
+        if k in changed:
+            logger.warning("reload: %s needs a restart to change", k)
+            new[k] = config[k]
+    for i in range(4):
+        nm = 'TURFIO'+str(i)
+        if new['Ports'][nm] != config['Ports'][nm]:
+            logger.warning("reload: %s port needs a restart to change", nm)
+            new['Ports'][nm] = config['Ports'][nm]
+    old = dict(config)
+    config.clear()
+    config.update(new)
+
+    logging.getLogger().setLevel(config['LogLevel'])
+    downstreamRoutes.maxAge = config['RouteMaxAge']
+    upstreamRoutes.maxAge = config['UpstreamRouteMaxAge']
+    pending.timeout = config['PendingTimeout']
+    packetsForDownstream.maxsize = config['RouterQueueSize']
+    packetsForUpstream.maxsize = config['RouterQueueSize']
+
+    # static routes
+    for i in range(4):
+        nm = 'TURFIO'+str(i)
+        oldSources = set(old[nm].get('KnownSources', []))
+        newSources = set(config[nm].get('KnownSources', []))
+        for sid in oldSources - newSources:
+            downstreamRoutes.forget(sid, downstreams[i])
+        for sid in newSources - oldSources:
+            downstreamRoutes.addStatic(sid, downstreams[i])
+
+    # per-link knobs
+    for dh in downstreams:
+        dh.configure(window=config['DownstreamWindow'] if dh in downstreams[:4] else None,
+                     timeout=config['DownstreamTimeout'],
+                     minTimeout=config['DownstreamMinTimeout'],
+                     commandTimeouts=config['Timeouts'],
+                     weights=config['Weights'],
+                     queueSize=config['LinkQueueSize'],
+                     fifoSize=config['FifoSize'])
+    for uh in upstreams:
+        uh.configure(fifoSize=config['FifoSize'])
+
+    # upstreams that went away, or moved
+    running = { uh.name : uh for uh in upstreams }
+    for nm, uh in running.items():
+        moved = nm != 'LOCAL' and config['Ports'].get(nm) != old['Ports'].get(nm)
+        if nm in config['Upstreams'] and not moved:
+            continue
+        logger.info("reload: stopping %s", nm)
+        upstreams.remove(uh)
+        stalled.pop(uh, None)
+        for sid in upstreamRoutes.sources(uh):
+            upstreamRoutes.forget(sid, uh)
+        uh.close()
+    # and ones that showed up. keep their old spot in the link list
+    running = set(uh.name for uh in upstreams)
+    for nm in UPSTREAM_NAMES:
+        if nm not in config['Upstreams'] or nm in running:
+            continue
+        logger.info("reload: starting %s", nm)
+        uh = makeUpstream(nm)
+        names = [ l.name for l in links ]
+        if nm in names:
+            links[names.index(nm)] = uh
+        else:
+            links.append(uh)
+            if recorder:
+                recorder.setLinkName(len(links)-1, nm)
+        linkIndex[uh] = links.index(uh)
+        # upstreams stay in UPSTREAM_NAMES order
+        upstreams.append(uh)
+        upstreams.sort(key=lambda l : UPSTREAM_NAMES.index(l.name))
+        uh.start(callback=makeUpstreamHandler(uh))
+
+    gather.timeout = config['GatherTimeout']
+
+    # the optional bits
+    if not config['HealthEnable']:
+        health = None
+    elif health is None:
+        health = makeHealth()
+    else:
+        health.threshold = config['HealthThreshold']
+        health.probeInterval = config['HealthProbeInterval']
+        health.maxProbeInterval = config['HealthMaxProbeInterval']
+    if not config['CoalesceEnable']:
+        if coalescer:
+            sendCopies(coalescer.flush())
+        coalescer = None
+    elif coalescer is None:
+        coalescer = makeCoalescer()
+    else:
+        coalescer.commands = set(config['CoalesceCommands'])
+        coalescer.window = config['CoalesceWindow']
+        coalescer.timeout = config['PendingTimeout']
+    if not (config['PollerEnable'] and config['PollerCommands']):
+        poller = None
+    elif poller is None:
+        poller = makePoller()
+    else:
+        poller.configure(config['PollerCommands'],
+                         ids=discoveryIds(),
+                         maxAge=config['PollerMaxAge'])
+    if not config['DiscoveryEnable']:
+        discovery = None
+    elif discovery is None:
+        discovery = makeDiscovery()
+    else:
+        discovery.ids = list(discoveryIds())
+        discovery.interval = config['DiscoveryInterval']
+        discovery.timeout = config['DiscoveryTimeout']
+    pollers = buildPollers()
+###########################################################################
+
 # start the upstreams
 for uh in upstreams:
     logger.info("starting %s handler", uh.name)
@@ -200,7 +937,13 @@ for dh in downstreams:
     dh.start(callback=makeDownstreamHandler(dh))
         
 while not handler.terminate:
-    events = sel.select()
+    # come back in time for whoever needs servicing soonest
+    timeout = None
+    for poll in pollers:
+        t = poll()
+        if t is not None and (timeout is None or t < timeout):
+            timeout = t
+    events = sel.select(timeout)
     for key, mask in events:
         callback = key.data
         try:
@@ -212,32 +955,26 @@ while not handler.terminate:
             handler.set_terminate()
 
     # HOUSEKEEPING ROUTER!!
-    while not packetsForDownstream.empty():
-        pkt = packetsForDownstream.get()
-        dst = pkt[1]
-        delivered = False
-        for dh in downstreams:
-            if dst in dh.sources:
-                dh.sendPacket(pkt)
-                delivered = True
-        if not delivered:
-            for dh in downstreams:
-                dh.sendPacket(pkt)
-    while not packetsForUpstream.empty():
-        pkt = packetsForUpstream.get()
-        dst = pkt[1]
-        logger.info(f'trying to find an upstream for destination {hex(dst)}')
-        for uh in upstreams:
-            logger.trace(f'upstream {uh.name} has sources {uh.sources}')
-            if dst in uh.sources:
-                logger.info(f'forwarding packet to {uh.name}')
-                uh.sendPacket(pkt)
-                
+    if reloadPending:
+        reloadPending = False
+        reloadConfig()
+    checkTimeouts()
+    retryStalled()
+    for pkt, ingress in packetsForDownstream.drain():
+        forwardDownstream(pkt, ingress)
+    for pkt, ingress in packetsForUpstream.drain():
+        routeUpstream(pkt, ingress)
+
 logger.info("Terminating!")
+saveSnapshot()
 for uh in upstreams:
     uh.stop()
 for dh in downstreams:
     dh.stop()
+if recorder:
+    recorder.close()
+statsServer.close()
+os.unlink(config['StatsPath'])
 
 os.remove(config['TurfPath'])
 
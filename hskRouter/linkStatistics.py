@@ -0,0 +1,127 @@
+# Per-link statistics for the housekeeping router.
+#
+# These are full-width counters (Python ints, so they don't wrap) plus
+# round-trip time histograms, for the link as a whole and for each
+# destination ID we've sent requests to through it. They belong to the
+# SerHandler, not the packet handler, so they survive a stop/start.
+#
+# Downstream links also keep a histogram of how long packets from each
+# source (upstream) sat in the queue before being sent.
+#
+# RTT histograms are log2 binned in milliseconds: bin 0 is < 1 ms,
+# bin i is [2^(i-1), 2^i) ms, and the last bin is everything above.
+import struct
+import threading
+
+class RttHistogram:
+    NBINS = 16
+    def __init__(self):
+        self.bins = [0]*self.NBINS
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, rtt):
+        b = min(int(rtt*1000).bit_length(), self.NBINS-1)
+        self.bins[b] += 1
+        self.count += 1
+        self.total += rtt
+        if self.min is None or rtt < self.min:
+            self.min = rtt
+        if self.max is None or rtt > self.max:
+            self.max = rtt
+
+    def merge(self, other):
+        for i in range(self.NBINS):
+            self.bins[i] += other.bins[i]
+        self.count += other.count
+        self.total += other.total
+        for v in (other.min, other.max):
+            if v is None:
+                continue
+            if self.min is None or v < self.min:
+                self.min = v
+            if self.max is None or v > self.max:
+                self.max = v
+
+    def asDict(self):
+        return { 'bins' : list(self.bins),
+                 'count' : self.count,
+                 'mean' : self.total/self.count if self.count else None,
+                 'min' : self.min,
+                 'max' : self.max }
+
+    def pack(self):
+        """ bins as big-endian 32-bit counts (saturating) """
+        return struct.pack(">%dI" % self.NBINS,
+                           *(min(b, 0xFFFFFFFF) for b in self.bins))
+
+class LinkStatistics:
+    COUNTERS = ( 'received', 'sent', 'errors', 'dropped', 'timeouts', 'broadcasts' )
+    def __init__(self, name=None):
+        self.name = name
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.rtt = RttHistogram()
+        # dst : RttHistogram
+        self.dstRtt = {}
+        # source : RttHistogram of queue wait times
+        self.wait = {}
+
+    def add(self, counter, n=1):
+        with self._lock:
+            self.counters[counter] += n
+            return self.counters[counter]
+
+    def restore(self, counters):
+        """ add in counters (a dict) saved from a previous run """
+        with self._lock:
+            for c, v in counters.items():
+                if c in self.counters:
+                    self.counters[c] += v
+
+    def addRtt(self, dst, rtt):
+        with self._lock:
+            self.rtt.add(rtt)
+            h = self.dstRtt.get(dst)
+            if h is None:
+                h = RttHistogram()
+                self.dstRtt[dst] = h
+            h.add(rtt)
+
+    def addWait(self, source, wait):
+        with self._lock:
+            h = self.wait.get(source)
+            if h is None:
+                h = RttHistogram()
+                self.wait[source] = h
+            h.add(wait)
+
+    def values(self):
+        """ counters as a list, in COUNTERS order """
+        with self._lock:
+            return [ self.counters[c] for c in self.COUNTERS ]
+
+    def dstHistogram(self, dst):
+        """ a copy of the RTT histogram for dst (empty if none) """
+        h = RttHistogram()
+        with self._lock:
+            if dst in self.dstRtt:
+                h.merge(self.dstRtt[dst])
+        return h
+
+    def asDict(self):
+        with self._lock:
+            return { 'counters' : dict(self.counters),
+                     'rtt' : self.rtt.asDict(),
+                     'dstRtt' : { f'{d:#04x}' : h.asDict()
+                                  for d, h in sorted(self.dstRtt.items()) },
+                     'wait' : { str(s) : h.asDict() for s, h in self.wait.items() } }
+
+    def pack(self):
+        """ counters as big-endian 64-bit values, then the link RTT histogram """
+        with self._lock:
+            return (struct.pack(">%dQ" % len(self.COUNTERS),
+                                *(self.counters[c] for c in self.COUNTERS))
+                    + self.rtt.pack())
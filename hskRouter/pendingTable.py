@@ -0,0 +1,97 @@
+# Return path tracking for the housekeeping router.
+#
+# Upstream IDs get learned on every link they show up on, so a ground
+# ID that talks through both HSK0 and SFC has two routes, and sending
+# responses by route lookup delivers every one of them twice. Instead
+# every request we forward downstream goes in here, keyed by
+# (requester, target, command), along with the link it came in on.
+# The response goes back out that link only. The route lookup is just
+# for unsolicited stuff (or responses that took too long).
+#
+# Error responses have cmd 0xFF, so those match the oldest request
+# from the requester to the target regardless of command.
+#
+# Fragments (see hskframe) answer the ack that asked for them, or the
+# plain request whose response was too big for one packet, and a
+# window's worth of them comes back for each one, so the request only
+# gets retired by the one that ends the window.
+import time
+from collections import deque
+import hskframe
+
+class PendingTable:
+    kErrorCmd = 0xFF
+    def __init__(self, timeout=2.0, timeFn=time.monotonic):
+        """
+        timeout : seconds to wait for a response before forgetting a request
+        """
+        self.timeout = timeout
+        self.time = timeFn
+        # (requester, target, cmd) : deque of (ingress link, deadline)
+        self.pending = {}
+        self.matched = 0
+        self.unmatched = 0
+        self.expired = 0
+
+    def _expire(self, now):
+        for k in list(self.pending):
+            q = self.pending[k]
+            while q and q[0][1] <= now:
+                q.popleft()
+                self.expired += 1
+            if not q:
+                del self.pending[k]
+
+    def add(self, pkt, link):
+        """ request pkt, which came in on link, went downstream """
+        now = self.time()
+        self._expire(now)
+        key = (pkt[0], pkt[1], pkt[2])
+        q = self.pending.get(key)
+        if q is None:
+            q = deque()
+            self.pending[key] = q
+        q.append((link, now + self.timeout))
+
+    def _oldest(self, keys):
+        """ whichever of keys has the oldest request pending, or None """
+        key = None
+        for k in keys:
+            q = self.pending.get(k)
+            if q and (key is None or q[0][1] < self.pending[key][0][1]):
+                key = k
+        return key
+
+    def match(self, pkt):
+        """ the ingress link of the request response pkt answers, or None """
+        self._expire(self.time())
+        key = (pkt[1], pkt[0], pkt[2])
+        keep = False
+        if pkt[2] == hskframe.kFragmentCmd:
+            # the oldest of the ack or the original command
+            keys = [ (pkt[1], pkt[0], hskframe.kFragmentAckCmd) ]
+            if pkt[3]:
+                keys.append((pkt[1], pkt[0], pkt[4]))
+            key = self._oldest(keys)
+            keep = not hskframe.isWindowEnd(pkt)
+        elif pkt[2] == self.kErrorCmd:
+            # oldest request of any command from them to whoever this is from
+            key = self._oldest(k for k in self.pending
+                               if k[0] == pkt[1] and k[1] == pkt[0])
+        q = self.pending.get(key)
+        if not q:
+            self.unmatched += 1
+            return None
+        self.matched += 1
+        if keep:
+            return q[0][0]
+        link = q.popleft()[0]
+        if not q:
+            del self.pending[key]
+        return link
+
+    def asDict(self):
+        return { 'pending' : sum(len(q) for q in self.pending.values()),
+                 'matched' : self.matched,
+                 'unmatched' : self.unmatched,
+                 'expired' : self.expired }
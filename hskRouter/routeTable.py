@@ -0,0 +1,135 @@
+# Routing table for the housekeeping router.
+#
+# Every housekeeping ID is a single byte, so instead of having
+# each link carry a list of sources that we scan for every packet
+# we just keep a 256-entry table indexed by ID. Each slot holds
+# the link(s) that own that ID and when we last heard from it there.
+#
+# Routes come from two places: KnownSources in the config (static,
+# they never age out) and sources we learn from received packets.
+# Learned routes age out after maxAge seconds so a SURF that moves or
+# goes away stops attracting traffic. A learned route on a different
+# link replaces the old one if the table is exclusive (downstream: a
+# SURF lives behind exactly one TURFIO). Upstream tables are not
+# exclusive, since the same ground ID can talk through several links.
+#
+# Learning happens in the reader threads, lookups in the main thread,
+# so everything is done under a lock. It's cheap.
+import threading
+import time
+
+class RouteTable:
+    def __init__(self,
+                 name='routes',
+                 maxAge=0,
+                 exclusive=True,
+                 timeFn=time.monotonic):
+        """
+        name : name used when dumping the table
+        maxAge : seconds before a learned route expires (0 = never)
+        exclusive : if True an ID can only be owned by one link
+        timeFn : monotonic time source
+        """
+        self.name = name
+        self.maxAge = maxAge
+        self.exclusive = exclusive
+        self.time = timeFn
+        self._lock = threading.Lock()
+        # each slot is None or a dict of link : last seen time.
+        # static routes have a last seen time of None.
+        self._routes = [None]*256
+
+    def addStatic(self, sid, link):
+        """ add a route which never ages out """
+        with self._lock:
+            r = self._routes[sid]
+            if r is None or self.exclusive:
+                self._routes[sid] = { link : None }
+            else:
+                r[link] = None
+
+    def learn(self, sid, link, age=0):
+        """ note that we heard sid on link (age seconds ago) """
+        now = self.time() - age
+        with self._lock:
+            r = self._routes[sid]
+            if r is None:
+                self._routes[sid] = { link : now }
+            elif link in r:
+                # don't downgrade a static route
+                if r[link] is not None:
+                    r[link] = now
+            elif self.exclusive:
+                # it moved
+                self._routes[sid] = { link : now }
+            else:
+                r[link] = now
+
+    def forget(self, sid, link=None):
+        """ remove the route(s) for sid, static or not """
+        with self._lock:
+            r = self._routes[sid]
+            if r is None:
+                return
+            if link is None:
+                self._routes[sid] = None
+            else:
+                r.pop(link, None)
+                if not r:
+                    self._routes[sid] = None
+
+    def _expire(self, sid, r, now):
+        expired = [ l for l, t in r.items()
+                    if t is not None and now - t > self.maxAge ]
+        for l in expired:
+            del r[l]
+        if not r:
+            self._routes[sid] = None
+
+    def lookup(self, sid):
+        """ return a tuple of the links which own sid (empty if none) """
+        with self._lock:
+            r = self._routes[sid]
+            if r is None:
+                return ()
+            if self.maxAge:
+                self._expire(sid, r, self.time())
+            return tuple(r)
+
+    def sources(self, link):
+        """ return the list of IDs currently routed to link """
+        now = self.time()
+        with self._lock:
+            s = []
+            for sid in range(256):
+                r = self._routes[sid]
+                if r is None:
+                    continue
+                if self.maxAge:
+                    self._expire(sid, r, now)
+                if link in r:
+                    s.append(sid)
+            return s
+
+    def learned(self):
+        """ return a list of (sid, link, age) for every learned route """
+        now = self.time()
+        with self._lock:
+            return [ (sid, l, now - t)
+                     for sid in range(256) if self._routes[sid] is not None
+                     for l, t in self._routes[sid].items() if t is not None ]
+
+    def dump(self):
+        """ return a list of human-readable lines describing the table """
+        now = self.time()
+        lines = [ f'{self.name}: maxAge {self.maxAge}' ]
+        with self._lock:
+            for sid in range(256):
+                r = self._routes[sid]
+                if r is None:
+                    continue
+                for l, t in r.items():
+                    age = 'static' if t is None else f'{now-t:.3f}s'
+                    nm = getattr(l, 'name', repr(l))
+                    lines.append(f'  {sid:#04x} -> {nm} ({age})')
+        return lines
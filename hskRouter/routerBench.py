@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+
+# Load-test bench for the housekeeping router, no hardware needed.
+#
+# Every serial port the router talks to (the TURFIO links, the HSK
+# upstreams and the SFC SPI bridge) becomes a RawPTY in a scratch
+# directory, and the router gets run as a subprocess with an ini that
+# points its [Ports] at them. Behind each TURFIO pty a thread plays a
+# crate of SURFs that answer after a configurable latency, lose some
+# fraction of requests, and occasionally spit garbage onto the line.
+# On the upstream side each link runs a closed-loop driver that keeps
+# a number of requests outstanding, picking destinations and commands
+# from the request mix.
+#
+# At the end you get packets/s, RTT percentiles and loss per upstream,
+# plus the router's own counters (drops, timeouts...) from its stats
+# socket, so you can compare router changes on a laptop. --json dumps
+# the whole thing if you want to diff runs. --bad-reload SIGHUPs the
+# router halfway through with a broken ini and then a missing one, and
+# fails if that takes it down.
+#
+# The router needs its single-file modules (rawpty, eventqueue,
+# hskframe, signalhandler) on the path. The ones in this repo get
+# added automatically, signalhandler comes from pueo-utils.
+import argparse
+import configparser
+import heapq
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.dirname(here)
+MODULE_DIRS = [ os.path.join(top, d) for d in ('rawpty', 'eventqueue', 'hskframe') ]
+MODULE_DIRS.append(os.path.join(top, 'pueo-utils', 'signalhandler'))
+sys.path[:0] = MODULE_DIRS
+
+import hskframe
+from rawpty import RawPTY
+
+ROUTER = os.path.join(here, 'hskRouter.py')
+ROUTER_INI = os.path.join(here, 'hskRouter.ini')
+UPSTREAMS = ( 'HSK0', 'HSK1', 'SFC' )
+# source ID each upstream driver uses
+UPSTREAM_IDS = { 'HSK0' : 0x10, 'HSK1' : 0x11, 'SFC' : 0x12 }
+kErrorCmd = 0xFF
+
+def makePacket(src, dst, cmd, data=b''):
+    pkt = bytearray([src, dst, cmd, len(data)])
+    pkt += data
+    pkt.append((256 - sum(data)) & 0xFF)
+    return bytes(pkt)
+
+def readFrames(fd, stop, callback):
+    """ read frames off fd until stop is set, calling callback(pkt) for each good one """
+    buf = bytearray()
+    while not stop.is_set():
+        try:
+            d = os.read(fd, 4096)
+        except OSError:
+            return
+        if not d:
+            return
+        buf += d
+        while True:
+            i = buf.find(b'\x00')
+            if i < 0:
+                break
+            frame = bytes(buf[:i])
+            del buf[:i+1]
+            if not frame:
+                continue
+            pkt, skipped = hskframe.decode(frame)
+            if pkt is None or hskframe.check(pkt):
+                continue
+            callback(pkt)
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(p/100*len(values)), len(values)-1)]
+
+class SimulatedCrate:
+    """ a bunch of SURFs behind one TURFIO pty """
+    def __init__(self, pty, ids, latency, jitter, loss, garbage, respLen, rng):
+        self.pty = pty
+        self.fd = pty.pty
+        self.ids = set(ids)
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.garbage = garbage
+        self.respLen = respLen
+        self.rng = rng
+        self.stop = threading.Event()
+        self.lock = threading.Condition()
+        # (time due, seq, packet)
+        self.pending = []
+        self.seq = 0
+        self.counts = dict.fromkeys(('requests', 'answered', 'lost', 'garbage'), 0)
+        self.threads = [ threading.Thread(target=readFrames,
+                                          args=(self.fd, self.stop, self.request),
+                                          daemon=True),
+                         threading.Thread(target=self.responder, daemon=True) ]
+
+    def start(self):
+        for t in self.threads:
+            t.start()
+
+    def request(self, pkt):
+        if pkt[1] not in self.ids:
+            return
+        self.counts['requests'] += 1
+        if self.rng.random() < self.loss:
+            self.counts['lost'] += 1
+            return
+        # pings get an empty pong, everything else gets respLen bytes
+        data = bytes(self.rng.getrandbits(8) for _ in range(self.respLen if pkt[2] else 0))
+        rsp = makePacket(pkt[1], pkt[0], pkt[2], data)
+        due = time.monotonic() + max(0, self.rng.gauss(self.latency, self.jitter))
+        with self.lock:
+            self.seq += 1
+            heapq.heappush(self.pending, (due, self.seq, rsp))
+            self.lock.notify()
+
+    def responder(self):
+        while not self.stop.is_set():
+            with self.lock:
+                now = time.monotonic()
+                if not self.pending or self.pending[0][0] > now:
+                    wait = self.pending[0][0] - now if self.pending else 0.1
+                    self.lock.wait(min(wait, 0.1))
+                    continue
+                rsp = heapq.heappop(self.pending)[2]
+            out = b''
+            if self.rng.random() < self.garbage:
+                self.counts['garbage'] += 1
+                out += bytes(self.rng.getrandbits(8) for _ in range(self.rng.randint(1, 16)))
+                # sometimes it's a stray terminator, sometimes it's glued on the front
+                if self.rng.random() < 0.5:
+                    out += b'\x00'
+            out += hskframe.encode(rsp)
+            try:
+                os.write(self.fd, out)
+            except OSError:
+                return
+            self.counts['answered'] += 1
+
+class UpstreamDriver:
+    """ closed-loop request generator on one upstream pty """
+    def __init__(self, name, pty, src, targets, mix, outstanding, timeout, reqLen, rng):
+        self.name = name
+        self.fd = pty.pty
+        self.src = src
+        self.targets = list(targets)
+        self.cmds = [ c for c, w in mix ]
+        self.weights = [ w for c, w in mix ]
+        self.outstanding = outstanding
+        self.timeout = timeout
+        self.reqLen = reqLen
+        self.rng = rng
+        self.stop = threading.Event()
+        self.lock = threading.Condition()
+        # dst : (cmd, time sent). only one per destination, like the SURFs
+        self.inflight = {}
+        self.rtts = []
+        self.counts = dict.fromkeys(('sent', 'answered', 'errors', 'timeouts'), 0)
+        self.reader = threading.Thread(target=readFrames,
+                                       args=(self.fd, self.stop, self.response),
+                                       daemon=True)
+        self.writer = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.reader.start()
+        self.writer.start()
+
+    def response(self, pkt):
+        now = time.monotonic()
+        with self.lock:
+            req = self.inflight.get(pkt[0])
+            if pkt[1] != self.src or req is None:
+                return
+            cmd, tsent = req
+            if pkt[2] == kErrorCmd:
+                self.counts['errors'] += 1
+            elif pkt[2] == cmd:
+                self.counts['answered'] += 1
+                self.rtts.append(now - tsent)
+            else:
+                return
+            del self.inflight[pkt[0]]
+            self.lock.notify()
+
+    def run(self):
+        while not self.stop.is_set():
+            with self.lock:
+                now = time.monotonic()
+                for dst, (cmd, tsent) in list(self.inflight.items()):
+                    if now - tsent > self.timeout:
+                        self.counts['timeouts'] += 1
+                        del self.inflight[dst]
+                free = [ t for t in self.targets if t not in self.inflight ]
+                if len(self.inflight) >= self.outstanding or not free:
+                    self.lock.wait(0.01)
+                    continue
+                dst = self.rng.choice(free)
+                cmd = self.rng.choices(self.cmds, self.weights)[0]
+                self.inflight[dst] = (cmd, now)
+                self.counts['sent'] += 1
+            data = bytes(self.rng.getrandbits(8) for _ in range(self.reqLen if cmd else 0))
+            try:
+                os.write(self.fd, hskframe.encode(makePacket(self.src, dst, cmd, data)))
+            except OSError:
+                return
+
+    def report(self, elapsed):
+        rtts = self.rtts
+        return { 'sent' : self.counts['sent'],
+                 'answered' : self.counts['answered'],
+                 'errors' : self.counts['errors'],
+                 'timeouts' : self.counts['timeouts'],
+                 'pps' : self.counts['answered']/elapsed,
+                 'rttP50' : percentile(rtts, 50),
+                 'rttP99' : percentile(rtts, 99),
+                 'rttMax' : max(rtts) if rtts else None }
+
+def parseMix(s):
+    """ 'cmd[:weight],...' -> [(cmd, weight)] """
+    mix = []
+    for item in s.split(','):
+        f = item.split(':')
+        mix.append((int(f[0], 0), float(f[1]) if len(f) > 1 else 1.0))
+    return mix
+
+def writeConfig(args, tmp, ports):
+    parser = configparser.ConfigParser()
+    parser.optionxform = str
+    parser.read(args.config)
+    for sect in ('hskRouter', 'Ports', 'Discovery'):
+        if not parser.has_section(sect):
+            parser.add_section(sect)
+    r = parser['hskRouter']
+    r['LogLevel'] = str(args.log_level)
+    r['Upstreams'] = ', '.join(list(UPSTREAMS) + ['LOCAL'])
+    r['TurfPath'] = os.path.join(tmp, 'hskturf')
+    r['LocalPath'] = os.path.join(tmp, 'hsklocal')
+    r['RouteDumpPath'] = os.path.join(tmp, 'routes')
+    r['RecorderPath'] = os.path.join(tmp, 'ring')
+    r['RecorderDumpPath'] = os.path.join(tmp, 'ring.txt')
+    r['StatsPath'] = os.path.join(tmp, 'stats')
+    r['SnapshotPath'] = os.path.join(tmp, 'snap')
+    if args.engine:
+        r['Engine'] = args.engine
+    if args.window:
+        r['DownstreamWindow'] = str(args.window)
+    for k, v in ports.items():
+        parser['Ports'][k] = v
+    parser['Discovery']['Timeout'] = str(args.discovery_timeout)
+    path = os.path.join(tmp, 'hskRouter.ini')
+    with open(path, 'w') as f:
+        parser.write(f)
+    return path
+
+def badReloads(router, ini, pause=0.3):
+    """
+    SIGHUP the router with a broken ini and then with none at all: it
+    should log it and keep running on the config it has. The good ini
+    goes back (and gets reloaded) afterwards.
+    """
+    with open(ini) as f:
+        good = f.read()
+    try:
+        parser = configparser.ConfigParser()
+        parser.optionxform = str
+        parser.read_string(good)
+        parser['hskRouter']['DownstreamWindow'] = 'abc'
+        with open(ini, 'w') as f:
+            parser.write(f)
+        router.send_signal(signal.SIGHUP)
+        time.sleep(pause)
+        os.unlink(ini)
+        router.send_signal(signal.SIGHUP)
+        time.sleep(pause)
+    finally:
+        with open(ini, 'w') as f:
+            f.write(good)
+    router.send_signal(signal.SIGHUP)
+    time.sleep(pause)
+    if router.poll() is not None:
+        raise RuntimeError(f'router died on a bad reload (exit {router.returncode})')
+
+def routerStatistics(path):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(2.0)
+    s.connect(path)
+    data = b''
+    with s:
+        while True:
+            d = s.recv(65536)
+            if not d:
+                break
+            data += d
+    return json.loads(data)
+
+def fmt(v, scale=1000):
+    return '   -   ' if v is None else f'{v*scale:7.2f}'
+
+def printReport(rpt):
+    print(f"{rpt['elapsed']:.1f} s, {rpt['totalPps']:.1f} packets/s answered")
+    print(f"{'link':<6s} {'sent':>8s} {'answered':>8s} {'errors':>7s} {'timeouts':>8s} {'pkt/s':>8s} {'p50 ms':>7s} {'p99 ms':>7s} {'max ms':>7s}")
+    for nm, u in rpt['upstreams'].items():
+        print(f"{nm:<6s} {u['sent']:8d} {u['answered']:8d} {u['errors']:7d} {u['timeouts']:8d} "
+              f"{u['pps']:8.1f} {fmt(u['rttP50'])} {fmt(u['rttP99'])} {fmt(u['rttMax'])}")
+    print(f"{'crate':<8s} {'requests':>8s} {'answered':>8s} {'lost':>6s} {'garbage':>7s}")
+    for nm, c in rpt['crates'].items():
+        print(f"{nm:<8s} {c['requests']:8d} {c['answered']:8d} {c['lost']:6d} {c['garbage']:7d}")
+    if rpt['router']:
+        links = rpt['router']['links']
+        names = rpt['router']['linkOrder']
+        counters = list(links[names[0]]['counters'].keys())
+        print('router: ' + ' '.join(f'{c:>10s}' for c in counters))
+        for nm in names:
+            print(f'{nm:>7s} ' + ' '.join(f"{links[nm]['counters'][c]:10d}" for c in counters))
+
+if __name__ == "__main__":
+    anyint = lambda x : int(x, 0)
+    argp = argparse.ArgumentParser(description="Load test hskRouter against simulated SURFs on ptys.")
+    argp.add_argument("--config", default=ROUTER_INI, help="router ini to start from")
+    argp.add_argument("--duration", type=float, default=10.0, help="seconds to run for")
+    argp.add_argument("--surfs", type=int, default=7, help="SURFs per TURFIO")
+    argp.add_argument("--first-id", type=anyint, default=0x40, help="ID of the first SURF (8 IDs per TURFIO)")
+    argp.add_argument("--latency", type=float, default=0.002, help="SURF response latency (s)")
+    argp.add_argument("--jitter", type=float, default=0.0005, help="latency standard deviation (s)")
+    argp.add_argument("--loss", type=float, default=0.0, help="fraction of requests the SURFs ignore")
+    argp.add_argument("--garbage", type=float, default=0.0, help="fraction of responses with garbage injected")
+    argp.add_argument("--mix", type=parseMix, default=parseMix("0:1"), help="request mix as cmd[:weight],... (e.g. 0:1,0x12:4)")
+    argp.add_argument("--request-len", type=int, default=0, help="data bytes in each non-ping request")
+    argp.add_argument("--response-len", type=int, default=16, help="data bytes in each non-ping response")
+    argp.add_argument("--outstanding", type=int, default=4, help="requests kept in flight per upstream")
+    argp.add_argument("--upstreams", default=','.join(UPSTREAMS), help="upstreams to drive")
+    argp.add_argument("--timeout", type=float, default=1.0, help="seconds before a request counts as lost")
+    argp.add_argument("--engine", choices=('thread', 'selector'), help="override the router engine")
+    argp.add_argument("--window", type=int, help="override DownstreamWindow")
+    argp.add_argument("--discovery-timeout", type=float, default=0.5, help="discovery sweep timeout (s)")
+    argp.add_argument("--log-level", type=int, default=30, help="router log level")
+    argp.add_argument("--seed", type=int, help="random seed")
+    argp.add_argument("--json", help="also write the report here")
+    argp.add_argument("--bad-reload", action="store_true", help="halfway through, SIGHUP the router with a broken and then a missing ini")
+    argp.add_argument("--keep", action="store_true", help="keep the scratch directory (router ini, ring, route dump)")
+    args = argp.parse_args()
+
+    rng = random.Random(args.seed)
+    tmp = tempfile.mkdtemp(prefix='hskbench')
+    ptys = {}
+    ports = {}
+    for nm in UPSTREAMS + tuple('TURFIO'+str(i) for i in range(4)):
+        ports[nm] = os.path.join(tmp, nm)
+        ptys[nm] = RawPTY(ports[nm])
+
+    crates = {}
+    targets = []
+    for i in range(4):
+        nm = 'TURFIO'+str(i)
+        ids = range(args.first_id + 8*i, args.first_id + 8*i + args.surfs)
+        targets += ids
+        crates[nm] = SimulatedCrate(ptys[nm], ids,
+                                    args.latency, args.jitter,
+                                    args.loss, args.garbage,
+                                    args.response_len,
+                                    random.Random(rng.random()))
+        crates[nm].start()
+
+    ini = writeConfig(args, tmp, ports)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(MODULE_DIRS + [env.get('PYTHONPATH', '')])
+    router = subprocess.Popen([sys.executable, ROUTER, ini], env=env)
+    rpt = None
+    try:
+        # wait for the router to come up, then for discovery to finish
+        statsPath = os.path.join(tmp, 'stats')
+        end = time.monotonic() + 5.0
+        while not os.path.exists(statsPath):
+            if router.poll() is not None or time.monotonic() > end:
+                raise RuntimeError('router did not start')
+            time.sleep(0.05)
+        time.sleep(args.discovery_timeout + 0.2)
+
+        drivers = {}
+        for nm in args.upstreams.split(','):
+            drivers[nm] = UpstreamDriver(nm, ptys[nm], UPSTREAM_IDS[nm],
+                                         targets, args.mix,
+                                         args.outstanding, args.timeout,
+                                         args.request_len,
+                                         random.Random(rng.random()))
+        tstart = time.monotonic()
+        for d in drivers.values():
+            d.start()
+        if args.bad_reload:
+            time.sleep(args.duration/2)
+            badReloads(router, ini)
+            time.sleep(args.duration/2)
+        else:
+            time.sleep(args.duration)
+        for d in drivers.values():
+            d.stop.set()
+        elapsed = time.monotonic() - tstart
+        # let the stragglers come back
+        time.sleep(min(args.timeout, 0.5))
+
+        rpt = { 'args' : { k : v for k, v in vars(args).items() },
+                'elapsed' : elapsed,
+                'upstreams' : { nm : d.report(elapsed) for nm, d in drivers.items() },
+                'crates' : { nm : dict(c.counts) for nm, c in crates.items() },
+                'router' : routerStatistics(statsPath) }
+        rpt['totalPps'] = sum(u['pps'] for u in rpt['upstreams'].values())
+        allRtts = [ r for d in drivers.values() for r in d.rtts ]
+        rpt['rttP50'] = percentile(allRtts, 50)
+        rpt['rttP99'] = percentile(allRtts, 99)
+    finally:
+        router.send_signal(signal.SIGTERM)
+        try:
+            router.wait(5.0)
+        except subprocess.TimeoutExpired:
+            router.kill()
+        for c in crates.values():
+            c.stop.set()
+        if args.keep:
+            print(f'scratch directory is {tmp}')
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    printReport(rpt)
+    print(f"overall RTT p50 {fmt(rpt['rttP50']).strip()} ms p99 {fmt(rpt['rttP99']).strip()} ms")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rpt, f, indent=1)
@@ -0,0 +1,130 @@
+# Scatter-gather requests for the housekeeping router.
+#
+# Getting one command's answer from every SURF takes ~28 round trips
+# from the flight computer, each one paying the upstream serial
+# latency. Instead the flight computer can ask the router (RouterSource,
+# cmd 30) to do it: data is the target (a TURFIO index, or 0xFF for
+# all of them), the command, and its payload. The router sends that
+# command to every SURF routed behind the target(s) at once, waits
+# until they've all answered or the timeout runs out, and sends back
+# the answers packed into as few cmd 30 packets as it can.
+#
+# Each response packet's data is: packet index, packet count, then
+# records of ID, length, data. The length is the response's data
+# length, or one of the codes below if there isn't any.
+import time
+
+# no response (timed out or known to be down)
+NO_RESPONSE = 0xFF
+# it answered with an error
+ERROR_RESPONSE = 0xFE
+# answered, but too big to fit in a record
+TOO_LONG = 0xFD
+# index + count
+CHUNK_HEADER = 2
+MAX_DATA = 255
+MAX_RECORD = MAX_DATA - CHUNK_HEADER - 2
+
+class Gather:
+    def __init__(self, request, ingress, cmd, sids, deadline):
+        self.request = request
+        self.ingress = ingress
+        self.cmd = cmd
+        self.deadline = deadline
+        # sid : response data, or one of the codes. None = waiting
+        self.results = dict.fromkeys(sids)
+
+    def done(self):
+        return all(r is not None for r in self.results.values())
+
+    def pack(self):
+        """ the response data, as a list of chunks """
+        records = []
+        for sid in sorted(self.results):
+            r = self.results[sid]
+            if r is None:
+                r = NO_RESPONSE
+            if isinstance(r, int):
+                records.append(bytes([sid, r]))
+            elif len(r) > MAX_RECORD:
+                records.append(bytes([sid, TOO_LONG]))
+            else:
+                records.append(bytes([sid, len(r)]) + r)
+        chunks = [ b'' ]
+        for rec in records:
+            if CHUNK_HEADER + len(chunks[-1]) + len(rec) > MAX_DATA:
+                chunks.append(b'')
+            chunks[-1] += rec
+        return [ bytes([i, len(chunks)]) + c for i, c in enumerate(chunks) ]
+
+class ScatterGather:
+    kErrorCmd = 0xFF
+    def __init__(self,
+                 myID,
+                 send,
+                 timeout=0.5,
+                 timeFn=time.monotonic):
+        """
+        myID : source ID the router uses for its own packets
+        send : function(link, pkt) to send a packet out a link, False if it couldn't
+        timeout : seconds to wait for everyone to answer
+        """
+        self.myID = myID
+        self.send = send
+        self.timeout = timeout
+        self.time = timeFn
+        self.gathers = []
+
+    def start(self, request, ingress, cmd, payload, targets, down=()):
+        """
+        send cmd+payload to every (link, sid) in targets, except the
+        sids in down (or that couldn't be sent to) which are reported
+        as not answering. Returns the Gather if it's already done
+        (nothing to wait for), else None.
+        """
+        g = Gather(request, ingress, cmd,
+                   [ sid for link, sid in targets ],
+                   self.time() + self.timeout)
+        payload = bytes(payload)
+        for link, sid in targets:
+            if sid in down:
+                g.results[sid] = NO_RESPONSE
+                continue
+            pkt = bytearray([self.myID, sid, cmd, len(payload)])
+            pkt += payload
+            pkt.append((256 - sum(payload)) & 0xFF)
+            if not self.send(link, pkt):
+                g.results[sid] = NO_RESPONSE
+        if g.done():
+            return g
+        self.gathers.append(g)
+        return None
+
+    def response(self, pkt):
+        """ a packet addressed to us came back. Returns the Gathers it finished """
+        finished = []
+        for g in self.gathers:
+            if g.results.get(pkt[0], 0) is not None:
+                continue
+            if pkt[2] == self.kErrorCmd:
+                g.results[pkt[0]] = ERROR_RESPONSE
+            elif pkt[2] == g.cmd:
+                g.results[pkt[0]] = bytes(pkt[4:-1])
+            else:
+                continue
+            if g.done():
+                finished.append(g)
+            # only the oldest one waiting on this ID gets it
+            break
+        for g in finished:
+            self.gathers.remove(g)
+        return finished
+
+    def poll(self):
+        """ returns (Gathers that ran out of time, seconds until the next deadline or None) """
+        now = self.time()
+        expired = [ g for g in self.gathers if g.deadline <= now ]
+        for g in expired:
+            self.gathers.remove(g)
+        wake = min((g.deadline - now for g in self.gathers), default=None)
+        return expired, wake
@@ -0,0 +1,97 @@
+# Warm-start snapshot for the housekeeping router.
+#
+# Every restart used to start with empty routes and zeroed counters,
+# and until every SURF talked again everything for it got broadcast.
+# So every so often (and on the way out) we write the learned routes
+# and the link counters to a small binary file, and load it back at
+# startup. Links are stored by name, so it still works if the set of
+# links changed in between.
+#
+# Layout (little-endian):
+#   header   : magic, version, wall clock time written, payload length
+#   payload  : link count, then per link its name, counter count and
+#              counters (64-bit). route count, then per route the
+#              table index, ID, link name and age in seconds.
+#   crc32 of everything before it
+#
+# The file gets written to a temporary and renamed over the old one,
+# so a crash halfway through leaves the previous snapshot alone.
+import os
+import struct
+import time
+import zlib
+
+MAGIC = b'HSKSNAP\x00'
+VERSION = 1
+HEADER = struct.Struct('<8sHdI')
+LINK = struct.Struct('<8sB')
+ROUTE = struct.Struct('<BB8sf')
+CRC = struct.Struct('<I')
+
+def pack(links, tables, wall=None):
+    """
+    links : links with .name and .stats (LinkStatistics)
+    tables : RouteTables, stored by index
+    """
+    payload = bytearray([len(links)])
+    for l in links:
+        values = l.stats.values()
+        payload += LINK.pack(l.name.encode(), len(values))
+        payload += struct.pack('<%dQ' % len(values), *values)
+    routes = []
+    for i, t in enumerate(tables):
+        for sid, l, age in t.learned():
+            routes.append(ROUTE.pack(i, sid, l.name.encode(), age))
+    payload += struct.pack('<H', len(routes))
+    payload += b''.join(routes)
+    buf = HEADER.pack(MAGIC, VERSION,
+                      time.time() if wall is None else wall,
+                      len(payload)) + payload
+    return buf + CRC.pack(zlib.crc32(buf))
+
+def unpack(buf, counterNames):
+    """
+    counterNames : names for the stored counters, in order.
+    returns (wall time written, { link name : { counter : value } },
+    [ (table index, ID, link name, age) ]). Raises ValueError if it's
+    not a valid snapshot.
+    """
+    if len(buf) < HEADER.size + CRC.size:
+        raise ValueError('snapshot too short')
+    magic, version, wall, n = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not a snapshot file')
+    if len(buf) != HEADER.size + n + CRC.size:
+        raise ValueError('snapshot is the wrong length')
+    if CRC.unpack_from(buf, HEADER.size + n)[0] != zlib.crc32(buf[:HEADER.size+n]):
+        raise ValueError('snapshot CRC mismatch')
+    try:
+        off = HEADER.size
+        counters = {}
+        for i in range(buf[off]):
+            nm, nc = LINK.unpack_from(buf, off+1)
+            off += LINK.size
+            values = struct.unpack_from('<%dQ' % nc, buf, off+1)
+            off += 8*nc
+            counters[nm.rstrip(b'\x00').decode()] = dict(zip(counterNames, values))
+        off += 1
+        routes = []
+        for i in range(struct.unpack_from('<H', buf, off)[0]):
+            t, sid, nm, age = ROUTE.unpack_from(buf, off + 2 + i*ROUTE.size)
+            routes.append((t, sid, nm.rstrip(b'\x00').decode(), age))
+    except (struct.error, IndexError, UnicodeDecodeError):
+        raise ValueError('snapshot payload is corrupt')
+    return wall, counters, routes
+
+def write(path, buf):
+    """ atomically replace path with buf """
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(buf)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
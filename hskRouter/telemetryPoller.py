@@ -0,0 +1,119 @@
+# TURF-side telemetry poller and cache for the housekeeping router.
+#
+# Flight software wants temps/volts from every SURF, and every one of
+# those requests has to cross a 500 kbaud TURFIO link and wait its turn
+# in the SURF's stop-and-wait slot. Instead the router polls every SURF
+# it has a route to on its own schedule, using its own source ID, and
+# keeps the latest response per (SURF, command). An upstream request
+# for a polled command (with no payload, since that's what we polled
+# with) gets answered straight out of the cache if the entry is fresh
+# enough, and never goes downstream at all.
+import logging
+import time
+
+class TelemetryCache:
+    def __init__(self, maxAge=2.0, timeFn=time.monotonic):
+        """
+        maxAge : seconds an entry can be used for
+        """
+        self.maxAge = maxAge
+        self.time = timeFn
+        # (src, cmd) : (time received, data)
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def store(self, pkt):
+        """ store a response (src, dst, cmd, len, data, cksum) """
+        self.entries[(pkt[0], pkt[2])] = (self.time(), bytes(pkt[4:-1]))
+
+    def lookup(self, src, cmd):
+        """ fresh data for cmd from src, or None """
+        e = self.entries.get((src, cmd))
+        if e is None or self.time() - e[0] > self.maxAge:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return e[1]
+
+    def asDict(self):
+        now = self.time()
+        return { 'hits' : self.hits,
+                 'misses' : self.misses,
+                 'entries' : { f'{s:#04x}/{c}' : { 'age' : now - t, 'data' : d.hex() }
+                               for (s, c), (t, d) in sorted(self.entries.items()) } }
+
+class TelemetryPoller:
+    def __init__(self,
+                 myID,
+                 routes,
+                 send,
+                 commands,
+                 ids=range(0x40, 0x60),
+                 maxAge=2.0,
+                 logName="testing",
+                 timeFn=time.monotonic):
+        """
+        myID : source ID the router uses for its own packets
+        routes : the downstream RouteTable (only routed IDs get polled)
+        send : function(link, pkt) to send a packet out a link
+        commands : dict of command : seconds between polls
+        ids : IDs to poll
+        maxAge : seconds a cached response is good for
+        """
+        self.myID = myID
+        self.routes = routes
+        self.send = send
+        self.commands = dict(commands)
+        self.ids = list(ids)
+        self.logger = logging.getLogger(logName)
+        self.time = timeFn
+        self.cache = TelemetryCache(maxAge, timeFn)
+        # spread out the first polls a little so they don't all land at once
+        now = self.time()
+        self.nextPoll = { cmd : now + 0.1*i for i, cmd in enumerate(self.commands) }
+
+    def configure(self, commands, ids, maxAge):
+        """ change the schedule on the fly. the cache stays """
+        now = self.time()
+        self.commands = dict(commands)
+        self.ids = list(ids)
+        self.cache.maxAge = maxAge
+        self.nextPoll = { cmd : self.nextPoll.get(cmd, now)
+                          for cmd in self.commands }
+
+    def poll(self):
+        """ send whatever polls are due. returns seconds until the next one, or None """
+        now = self.time()
+        for cmd, due in self.nextPoll.items():
+            if now < due:
+                continue
+            self.nextPoll[cmd] = now + self.commands[cmd]
+            n = 0
+            for sid in self.ids:
+                for link in self.routes.lookup(sid):
+                    self.send(link, bytes([self.myID, sid, cmd, 0, 0]))
+                    n += 1
+            self.logger.debug("poller: sent %d cmd %d requests", n, cmd)
+        if not self.nextPoll:
+            return None
+        return max(min(self.nextPoll.values()) - now, 0)
+
+    def response(self, pkt):
+        """ a response addressed to us came back. True if it was ours """
+        if pkt[1] != self.myID or pkt[2] not in self.commands:
+            return False
+        self.cache.store(pkt)
+        return True
+
+    def answer(self, pkt):
+        """ the response to request pkt out of the cache, or None """
+        if pkt[2] not in self.commands or pkt[3] != 0:
+            return None
+        data = self.cache.lookup(pkt[1], pkt[2])
+        if data is None:
+            return None
+        rpkt = bytearray([pkt[1], pkt[0], pkt[2], len(data)])
+        rpkt += data
+        rpkt.append((256 - sum(data)) & 0xFF)
+        return rpkt
@@ -7,7 +7,8 @@
 # gets dropped and the verification gets pushed into the packet handler.
 #
 # The one thing we _add_ here is a function to store source IDs.
-# That will let us route stuff.
+# That will let us route stuff. The IDs go into a RouteTable shared
+# by all the links on the same side of the router.
 #
 # _damnit_, no, we need to do more. The issue is that with multiple
 # upstreams we need to make sure we're not sending multiple packets
@@ -18,15 +19,42 @@
 # packet, we clear the event and then wait for the inbound
 # readerthread to set the event, up to 0.1 ms, before sending
 # the next packet.
+#
+# NEWER PLAN: stop-and-wait on the whole link is way too slow
+# with 8 SURFs behind a TURFIO. The writer thread now uses a
+# RequestWindow: each destination can only have one request
+# outstanding, but requests to different destinations can overlap
+# up to the window size. Only a real matching response (or a
+# timeout) frees up a destination.
+#
+# TIMEOUTS: a flat timeout is too long for a healthy SURF and too
+# short for the slow commands. Each destination (and the link as a
+# whole, for destinations we haven't heard from yet) gets a TCP-style
+# RTO from its smoothed RTT and RTT variance, clamped between
+# minTimeout and the configured timeout, and doubled after every
+# timeout until the next response. Commands with an override just
+# get that, and don't count toward the estimates.
+#
+# ENGINE: all of the above is engine='thread'. With engine='selector'
+# there are no threads at all: the serial/pty fd is made nonblocking
+# and registered with the router's selector, reads get packetized and
+# validated inline, and writes go through a SelectorTransport that
+# buffers whatever the fd won't take. The downstream window gets
+# serviced from the main loop via poll(). Same SerHandler API either way.
 from serial.threaded import Packetizer, ReaderThread
 import logging
 import threading
 import traceback
-import queue
 import os
+import fcntl
+import time
 import selectors
-from cobs import cobs
+from collections import deque
 from serial import Serial
+import hskframe
+from eventqueue import EventQueue
+from routeTable import RouteTable
+from linkStatistics import LinkStatistics
 
 class SerHandler:
     def __init__(self,
@@ -36,66 +64,494 @@ class SerHandler:
                  port='/dev/ttySC0',
                  baud=460800,
                  downstream=False,
-                 knownSources=None):
+                 knownSources=None,
+                 routes=None,
+                 window=4,
+                 timeout=0.1,
+                 minTimeout=0.02,
+                 commandTimeouts=None,
+                 weights=None,
+                 queueSize=0,
+                 queuePolicy='block',
+                 fifoSize=0,
+                 fifoPolicy='drop-newest',
+                 engine='thread'):
+        if engine not in ('thread', 'selector'):
+            raise ValueError(f'unknown engine {engine}')
         self.selector = sel
         self.name = name
         self.logger = logging.getLogger(logName)
-        self.fifo = queue.Queue()
+        self.engine = engine
+        self.threaded = (engine == 'thread')
+        self.fifo = EventQueue(fifoSize,
+                               wakeup=self.threaded,
+                               policy=fifoPolicy)
         self.port = Serial(port, baud)
         self.handler = None
         self.transport = None
-        self.downstream = downstream        
-        self.sources = [] if not knownSources else knownSources
-        self.logger.trace(f'{self.name} sources is at {hex(id(self.sources))}')
+        self.downstream = downstream
+        self.window = window
+        self.timeout = timeout
+        self.minTimeout = minTimeout
+        self.commandTimeouts = commandTimeouts
+        self.weights = weights
+        self.queueSize = queueSize
+        self.queuePolicy = queuePolicy
+        self.callback = None
+        self.stats = LinkStatistics(name)
+        # destinations that timed out, for the router to pick up
+        self.timedOut = deque()
+        self.routes = routes if routes is not None else RouteTable(name)
+        if knownSources:
+            for sid in knownSources:
+                self.routes.addStatic(sid, self)
         
         def makePacketHandler():
             return SerPacketHandler(self.fifo,
                                     logName,
                                     self.addSource,
                                     self.name,
-                                    self.downstream)
+                                    self.downstream,
+                                    self.window,
+                                    self.threaded,
+                                    self.stats,
+                                    self.weights,
+                                    self.queueSize,
+                                    self.queuePolicy,
+                                    self.timeout,
+                                    self.minTimeout,
+                                    self.commandTimeouts,
+                                    self.timedOut.append)
 
-        self.reader = ReaderThread(self.port, makePacketHandler)
+        if self.threaded:
+            self.reader = ReaderThread(self.port, makePacketHandler)
+        else:
+            self.reader = None
+            self.makePacketHandler = makePacketHandler
         self.sendPacket = self.notRunningError
         self.statistics = self.notRunningError
 
     def start(self, callback=None):
         if not callback:
             callback = self.dumpPacket
-        self.reader.start()
-        transport, handler = self.reader.connect()
+        self.callback = callback
+        if self.threaded:
+            self.reader.start()
+            transport, handler = self.reader.connect()
+            self.selector.register(self.fifo.rfd,
+                                   selectors.EVENT_READ,
+                                   callback)
+        else:
+            # port.fd is valid now, even for an attached pty
+            handler = self.makePacketHandler()
+            transport = SelectorTransport(self.selector,
+                                          self.port.fd,
+                                          handler,
+                                          lambda mask : callback(None, mask),
+                                          self.fifo)
+            handler.connection_made(transport)
         self.handler = handler
         self.transport = transport
         self.sendPacket = self.handler.send_packet
         self.statistics = self.handler.statistics
 
-        self.selector.register(handler.rfd,
-                               selectors.EVENT_READ,
-                               callback)
-
     def stop(self):
         self.sendPacket = self.notRunningError
         self.statistics = self.notRunningError
+        if self.threaded:
+            # don't leave the reader thread stuck in a blocking put
+            self.fifo.release()
+            self.reader.stop()
+        elif self.transport:
+            self.transport.close()
+            self.handler.connection_lost(None)
         self.handler = None
         self.transport = None
-        self.reader.stop()
+
+    def close(self):
+        """ stop for good and let go of the port """
+        self.stop()
+        if self.threaded and self.callback:
+            try:
+                self.selector.unregister(self.fifo.rfd)
+            except KeyError:
+                # paused
+                pass
+        if hasattr(self.port, 'pty'):
+            # an attached pty belongs to its RawPTY, don't close it
+            self.port.is_open = False
+        else:
+            self.port.close()
+        self.fifo.close()
+
+    def configure(self,
+                  window=None,
+                  timeout=None,
+                  minTimeout=None,
+                  commandTimeouts=None,
+                  weights=None,
+                  queueSize=None,
+                  fifoSize=None):
+        """ change settings while running. None leaves a setting alone """
+        if fifoSize is not None:
+            self.fifo.maxsize = fifoSize
+        if window is not None:
+            self.window = window
+        if timeout is not None:
+            self.timeout = timeout
+        if minTimeout is not None:
+            self.minTimeout = minTimeout
+        if commandTimeouts is not None:
+            self.commandTimeouts = commandTimeouts
+        if weights is not None:
+            self.weights = weights
+        if queueSize is not None:
+            self.queueSize = queueSize
+        if self.handler is not None:
+            self.handler.configure(window, timeout, minTimeout, commandTimeouts,
+                                   weights, queueSize)
+
+    def poll(self):
+        """
+        Service the downstream window if we're not threaded. Returns
+        the number of seconds until it needs servicing again, or None.
+        """
+        if self.threaded or not self.downstream or self.handler is None:
+            return None
+        return self.handler.poll()
+
+    def queueDepths(self):
+        """ packets waiting to go down this link, per source """
+        if not self.downstream or self.handler is None:
+            return {}
+        return self.handler.queueDepths()
+
+    def drainTimeouts(self):
+        """ destinations that timed out since the last call """
+        expired = []
+        while self.timedOut:
+            expired.append(self.timedOut.popleft())
+        return expired
+
+    def rtoEstimates(self):
+        """ per destination (srtt, rttvar, current timeout) """
+        if not self.downstream or self.handler is None:
+            return {}
+        return self.handler.rtoEstimates()
+
+    def canAccept(self, source=None):
+        """ False if this link's queue for source is full """
+        if not self.downstream or self.handler is None:
+            return True
+        return self.handler.canAccept(source)
+
+    def pause(self):
+        """ stop handing packets to the callback (backpressure) """
+        if self.threaded:
+            self.selector.unregister(self.fifo.rfd)
+        else:
+            self.transport.pauseReading()
+
+    def resume(self):
+        """ undo pause() """
+        if self.threaded:
+            self.selector.register(self.fifo.rfd,
+                                   selectors.EVENT_READ,
+                                   self.callback)
+        else:
+            self.transport.resumeReading()
 
     def addSource(self, sid):
-        if sid not in self.sources:
-            self.sources.append(sid)
-        
+        self.routes.learn(sid, self)
+
+    @property
+    def sources(self):
+        return self.routes.sources(self)
+
     @staticmethod
     def notRunningError(*args):
         raise RuntimeError("the housekeeping handler is not running")
 
     def dumpPacket(self, fd, mask):
-        """ print out the received packet from the fifo """
-        if self.fifo.empty():
-            self.logger.error("dumpPacket called but FIFO is empty?")
+        """ print out the received packets from the fifo """
+        for pkt in self.fifo.drain():
+            self.logger.info("Pkt: %s", pkt.hex(sep=' '))
+
+# Transport for the selector engine. Reads whatever's there, hands it
+# to the packetizer, and if that produced any packets calls the
+# callback right away. Writes go straight to the fd, and if it won't
+# take everything the rest gets buffered and we ask for EVENT_WRITE.
+class SelectorTransport:
+    def __init__(self, sel, fd, handler, callback, fifo, readSize=4096):
+        self.selector = sel
+        self.fd = fd
+        self.handler = handler
+        self.callback = callback
+        self.fifo = fifo
+        self.readSize = readSize
+        self.logger = handler.logger
+        self.outBuffer = bytearray()
+        flag = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flag | os.O_NONBLOCK)
+        self.events = selectors.EVENT_READ
+        self.selector.register(fd, self.events, self.handleEvent)
+
+    def _setEvents(self, events):
+        if events != self.events:
+            self.events = events
+            self.selector.modify(self.fd, events, self.handleEvent)
+
+    def handleEvent(self, fileobj, mask):
+        if mask & selectors.EVENT_READ:
+            try:
+                data = os.read(self.fd, self.readSize)
+            except BlockingIOError:
+                data = None
+            except OSError as e:
+                # we don't get to die like a ReaderThread, so just stop reading
+                self.logger.error("%s: read failed (%s), no longer reading",
+                                  self.handler.name, repr(e))
+                self._setEvents(self.events & ~selectors.EVENT_READ)
+                data = None
+            if data:
+                # one read can hold more frames than the FIFO does, and
+                # nothing drains it until we call back, so hand the data
+                # over at most a FIFO's worth of frames at a time
+                step = self.fifo.maxsize*(hskframe.MIN_FRAME+1) or len(data)
+                for i in range(0, len(data), step):
+                    self.handler.data_received(data[i:i+step])
+                    if not self.fifo.empty():
+                        self.callback(mask)
+        if mask & selectors.EVENT_WRITE:
+            self._flush()
+
+    def _flush(self):
+        try:
+            nb = os.write(self.fd, self.outBuffer)
+        except BlockingIOError:
+            nb = 0
+        del self.outBuffer[:nb]
+        if self.outBuffer:
+            self._setEvents(self.events | selectors.EVENT_WRITE)
+        else:
+            self._setEvents(self.events & ~selectors.EVENT_WRITE)
+
+    def write(self, data):
+        if self.outBuffer:
+            self.outBuffer += data
             return
-        pktno = os.read(fd, 1)
-        pkt = self.fifo.get()
-        self.logger.info("Pkt %d: %s", pktno[0], pkt.hex(sep=' '))
+        try:
+            nb = os.write(self.fd, data)
+        except BlockingIOError:
+            nb = 0
+        if nb < len(data):
+            self.outBuffer += data[nb:]
+            self._setEvents(self.events | selectors.EVENT_WRITE)
+
+    def pauseReading(self):
+        self._setEvents(self.events & ~selectors.EVENT_READ)
+
+    def resumeReading(self):
+        self._setEvents(self.events | selectors.EVENT_READ)
+
+    def close(self):
+        if self.events:
+            self.selector.unregister(self.fd)
+            self.events = 0
+
+# Bookkeeping for requests sent down a link that haven't been
+# answered yet. Requests to the same destination are serialized,
+# requests to different destinations overlap up to the window size.
+# A response comes back from the destination, to the requester, with
+# the same command - or with cmd 0xFF if it's an error response.
+#
+# Packets waiting to go out are queued per source (the upstream they
+# came in on) and picked with weighted deficit round robin, so a burst
+# from one upstream can't push everyone else's commands to the back.
+# Housekeeping packets are all small, so the cost is counted in
+# packets, not bytes: each visit a source gets weight packets of credit.
+#
+# Each source's queue holds at most queueSize packets. drop-oldest and
+# drop-newest do what they say. With block nothing is dropped here:
+# the router is expected to check full() and hold off on that source.
+# This guy has no locking: whoever owns it handles that.
+class RequestWindow:
+    kErrorCmd = 0xFF
+    def __init__(self,
+                 window=4,
+                 timeout=0.1,
+                 weights=None,
+                 queueSize=0,
+                 policy='block',
+                 minTimeout=0.02,
+                 commandTimeouts=None,
+                 timeFn=time.monotonic):
+        self.window = window
+        # this is the ceiling for the adaptive timeouts
+        self.timeout = timeout
+        self.minTimeout = minTimeout
+        self.commandTimeouts = commandTimeouts if commandTimeouts is not None else {}
+        self.linkRto = RtoEstimator()
+        # dst : RtoEstimator
+        self.rto = {}
+        self.weights = weights if weights is not None else {}
+        self.queueSize = queueSize
+        self.policy = policy
+        self.time = timeFn
+        # source : deque of (packet, time queued)
+        self.queues = {}
+        self.order = []
+        self.deficit = {}
+        self.current = 0
+        # dst : (src, cmd, deadline, time sent)
+        self.outstanding = {}
+
+    def push(self, pkt, source=None):
+        """ queue pkt from source. returns False if something got dropped """
+        q = self.queues.get(source)
+        if q is None:
+            q = deque()
+            self.queues[source] = q
+            self.order.append(source)
+            self.deficit[source] = 0
+        ok = True
+        if self.queueSize and len(q) >= self.queueSize:
+            if self.policy == 'drop-newest':
+                return False
+            elif self.policy == 'drop-oldest':
+                q.popleft()
+                ok = False
+        q.append((pkt, self.time()))
+        return ok
+
+    def full(self, source=None):
+        q = self.queues.get(source)
+        return bool(self.queueSize) and q is not None and len(q) >= self.queueSize
+
+    def depths(self):
+        """ number of packets waiting, per source """
+        return { src : len(q) for src, q in self.queues.items() }
+
+    def _sendable(self, q):
+        for i, (pkt, t) in enumerate(q):
+            if pkt[1] not in self.outstanding:
+                return i
+        return None
+
+    def next(self):
+        """
+        Return (packet, source, time spent queued) for the next packet that
+        can be sent, marking it outstanding, or None.
+        """
+        if len(self.outstanding) >= self.window or not self.order:
+            return None
+        for _ in range(len(self.order)+1):
+            src = self.order[self.current]
+            q = self.queues[src]
+            i = self._sendable(q)
+            if i is not None and self.deficit[src] >= 1:
+                pkt, queued = q[i]
+                del q[i]
+                self.deficit[src] -= 1
+                if not q:
+                    self.deficit[src] = 0
+                now = self.time()
+                self.outstanding[pkt[1]] = (pkt[0], pkt[2],
+                                            now + self.requestTimeout(pkt[1], pkt[2]),
+                                            now)
+                return pkt, src, now - queued
+            if i is None:
+                # nothing to send, so no banking credit
+                self.deficit[src] = 0
+            self.current = (self.current + 1) % len(self.order)
+            src = self.order[self.current]
+            self.deficit[src] += self.weights.get(src, 1)
+        return None
+
+    def response(self, pkt):
+        """
+        Check if pkt answers an outstanding request, and retire it if so.
+        Returns the round-trip time if it did, None otherwise.
+        """
+        o = self.outstanding.get(pkt[0])
+        if o is None or o[0] != pkt[1]:
+            return None
+        if pkt[2] != o[1] and pkt[2] != self.kErrorCmd:
+            # the first fragment answers the ack that asked for it, or
+            # the request itself if it was too big for one packet
+            if not (pkt[2] == hskframe.kFragmentCmd and
+                    (o[1] == hskframe.kFragmentAckCmd or (pkt[3] and o[1] == pkt[4]))):
+                return None
+        del self.outstanding[pkt[0]]
+        rtt = self.time() - o[3]
+        if o[1] not in self.commandTimeouts:
+            est = self.rto.get(pkt[0])
+            if est is None:
+                est = RtoEstimator()
+                self.rto[pkt[0]] = est
+            est.sample(rtt)
+            self.linkRto.sample(rtt)
+        return rtt
+
+    def requestTimeout(self, dst, cmd):
+        """ how long to wait for a response to cmd from dst """
+        t = self.commandTimeouts.get(cmd)
+        if t is not None:
+            return t
+        est = self.rto.get(dst)
+        t = est.rto() if est is not None else self.linkRto.rto()
+        if t is None:
+            return self.timeout
+        return min(max(t, self.minTimeout), self.timeout)
+
+    def rtoEstimates(self):
+        """ dst : (srtt, rttvar, current timeout) """
+        return { dst : (e.srtt, e.rttvar, self.requestTimeout(dst, None))
+                 for dst, e in self.rto.items() }
+
+    def expire(self):
+        """ Retire timed-out requests, returning the list of their destinations. """
+        now = self.time()
+        expired = [ dst for dst, o in self.outstanding.items() if o[2] <= now ]
+        for dst in expired:
+            o = self.outstanding.pop(dst)
+            # something that's never answered (discovery pings of absent
+            # IDs, broadcasts) just uses the link's estimate, it doesn't
+            # get to back it off for everyone else
+            est = self.rto.get(dst)
+            if o[1] not in self.commandTimeouts and est is not None:
+                est.timedOut()
+        return expired
+
+    def deadline(self):
+        """ Earliest time an outstanding request times out, or None. """
+        if not self.outstanding:
+            return None
+        return min(o[2] for o in self.outstanding.values())
+
+# RFC 6298 retransmission timeout estimate
+class RtoEstimator:
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.backoff = 1
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt/2
+        else:
+            self.rttvar = 0.75*self.rttvar + 0.25*abs(self.srtt - rtt)
+            self.srtt = 0.875*self.srtt + 0.125*rtt
+        self.backoff = 1
+
+    def timedOut(self):
+        self.backoff = min(self.backoff*2, 64)
+
+    def rto(self):
+        if self.srtt is None:
+            return None
+        return (self.srtt + 4*self.rttvar)*self.backoff
 
 # generic-y handler. This one adds checksum verification
 class SerPacketHandler(Packetizer):
@@ -104,36 +560,51 @@ class SerPacketHandler(Packetizer):
                  logName='serPacketHandler',
                  addSource=lambda x : None,
                  name=None,
-                 downstream=False):
+                 downstream=False,
+                 window=4,
+                 threaded=True,
+                 stats=None,
+                 weights=None,
+                 queueSize=0,
+                 queuePolicy='block',
+                 timeout=0.1,
+                 minTimeout=0.02,
+                 commandTimeouts=None,
+                 onTimeout=lambda dst : None):
         super(SerPacketHandler, self).__init__()
-        self.rfd, self.wfd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
         self.fifo = fifo
         self.logger = logging.getLogger(logName)
-        self._statisticsLock = threading.Lock()
-
-        self._receivedPackets = 0
-        self._sentPackets = 0
-        self._errorPackets = 0
-        self._droppedPackets = 0
-        self._mod = lambda x : x & 0xFF
+        # full-width counters and RTTs. these belong to the SerHandler
+        self.stats = stats if stats is not None else LinkStatistics(name)
         self.addSource = addSource
+        self.onTimeout = onTimeout
         self.downstream = downstream
+        self.threaded = threaded
         self.name = name
         if self.downstream:
-            # create an event to signal that we got a response
-            self.inPacketEvent = threading.Event()
-            # create a queue for the writer thread
-            self.downstreamWriteFifo = queue.Queue()
-            self.send_packet = self.send_packet_downstream
+            # the writer thread waits on this for new packets,
+            # responses, or timeouts
+            self.writeCondition = threading.Condition()
+            self.requestWindow = RequestWindow(window,
+                                               timeout=timeout,
+                                               minTimeout=minTimeout,
+                                               commandTimeouts=commandTimeouts,
+                                               weights=weights,
+                                               queueSize=queueSize,
+                                               policy=queuePolicy)
+            if self.threaded:
+                self.send_packet = self.send_packet_downstream
+            else:
+                self.send_packet = self.send_packet_downstream_inline
         else:
-            self.inPacketEvent = None
+            self.requestWindow = None
             self.send_packet = self.send_packet_upstream
         # we start off having no write thread
         self.writeThread = None
         
     def connection_made(self, transport):
         super(SerPacketHandler, self).connection_made(transport)
-        if self.downstream:
+        if self.downstream and self.threaded:
             # create the write thread in a running state
             self.terminate = False
             self.writeThread = threading.Thread(target=self.downstream_thread_send_packet)
@@ -145,127 +616,164 @@ class SerPacketHandler(Packetizer):
             self.logger.error(f'{self.name} : port closed due to exception')            
             raise exc
         if self.writeThread:
-            # stop the write thread. This might take a second (literally a second).
-            self.terminate = True
+            # stop the write thread.
+            with self.writeCondition:
+                self.terminate = True
+                self.writeCondition.notify()
             self.writeThread.join()
             self.writeThread = None
         self.logger.info("closed port")
 
     def handleErrorPacket(self, pkt, msg):
-        with self._statisticsLock:
-            self._errorPackets = self._errorPackets + 1
-            errorPackets = self._errorPackets
+        errorPackets = self.stats.add('errors')
         self.logger.error(msg+" #%d : %s ", errorPackets, pkt.hex(sep=' '))
 
-    def cobs_recovery(self, packet):
-        """ Attempt to recover a COBS packet that might have early garbage. """
-        min_size = 6
-        while not len(packet) < min_size:
-            packet = packet[1:]
-            try:
-                pkt = cobs.decode(packet)
-                return pkt
-            except cobs.DecodeError:
-                pass
-        return None
-    
     def handle_packet(self, packet):
         """ implement the handle_packet function """
         if len(packet) == 0:
             return
-        try:
-            pkt = cobs.decode(packet)
-        except cobs.DecodeError:
-            # attempt to recover packet. this is rare so
-            # don't care about the overhead
-            pkt = self.cobs_recovery(packet)
-            if pkt is None:
-                self.handleErrorPacket(packet, "COBS decode error")
-                return
-        # COBS decode ok. At this point just flag that we got something.
-        if self.inPacketEvent:
-            self.inPacketEvent.set()
-            
+        # this resyncs past early garbage if it has to
+        pkt, skipped = hskframe.decode(packet)
+        if pkt is None:
+            self.handleErrorPacket(packet, "COBS decode error")
+            return
+        if skipped:
+            self.logger.trace(f'{self.name}: skipped {skipped} bytes of garbage')
         # COBS decode ok. Next check packet length
         # and checksum
-        pktLen = len(pkt)
-        if pktLen < 5:
-            self.handleErrorPacket(pkt, "Packet too short")
-            return
-        if pkt[3] != pktLen-5:
-            self.handleErrorPacket(pkt, "Length of data (%d) doesn't match expected" % (pktLen-5))
+        err = hskframe.check(pkt)
+        if err:
+            self.handleErrorPacket(pkt, err)
             return
-        if sum(pkt[4:]) % 256:
-            self.handleErrorPacket(pkt, "Invalid checksum")
-            return
-        # it's ok
-        if not self.fifo.full():
-            with self._statisticsLock:
-                curPkt = self._receivedPackets
-                self._receivedPackets = self._receivedPackets + 1
-            # extract the source ID and add it to the list of sources we've seen
-            # except zero is a nono
-            if pkt[0]:
-                self.logger.trace(f'{self.name}: add known source {hex(pkt[0])}')
-                self.addSource(pkt[0])
-            self.fifo.put(pkt)
-            # write something to our selfpipe to wake up the main thread
-            toWrite = (curPkt & 0xFF).to_bytes(1, 'little')
-            nb = os.write(self.wfd, toWrite)
-            # wtf
-            if nb != 1:
-                self.logger.error("could not write packet number %d to pipe!" %
-                                  curPkt)
-        else:
-            with self._statisticsLock:
-                self._droppedPackets = self._droppedPackets + 1
-                droppedPackets = self._droppedPackets
+        # it's ok. if it answers something we sent, free up that destination
+        if self.requestWindow:
+            with self.writeCondition:
+                rtt = self.requestWindow.response(pkt)
+                if rtt is not None:
+                    self.writeCondition.notify()
+            if rtt is not None:
+                self.stats.addRtt(pkt[0], rtt)
+            if not self.threaded:
+                self.poll()
+        self.stats.add('received')
+        # extract the source ID and add it to the list of sources we've seen
+        # except zero is a nono
+        if pkt[0]:
+            self.logger.trace(f'{self.name}: add known source {hex(pkt[0])}')
+            self.addSource(pkt[0])
+        # this wakes up the main thread if it's not already awake.
+        # depending on the policy, this might block if we're backed up
+        dropped = self.fifo.put(pkt)
+        if dropped:
+            droppedPackets = self.stats.add('dropped', dropped)
             self.logger.error("packet FIFO is full: dropped packet count %d" %
                               droppedPackets)
-        
-    def send_packet_upstream(self, packet):
+
+    def queueDepths(self):
+        with self.writeCondition:
+            return self.requestWindow.depths()
+
+    def canAccept(self, source=None):
+        with self.writeCondition:
+            return not self.requestWindow.full(source)
+
+    def rtoEstimates(self):
+        with self.writeCondition:
+            return self.requestWindow.rtoEstimates()
+
+    def configure(self, window=None, timeout=None, minTimeout=None,
+                  commandTimeouts=None, weights=None, queueSize=None):
+        if not self.downstream:
+            return
+        with self.writeCondition:
+            rw = self.requestWindow
+            if window is not None:
+                rw.window = window
+            if timeout is not None:
+                rw.timeout = timeout
+            if minTimeout is not None:
+                rw.minTimeout = minTimeout
+            if commandTimeouts is not None:
+                rw.commandTimeouts = commandTimeouts
+            if weights is not None:
+                rw.weights = weights
+            if queueSize is not None:
+                rw.queueSize = queueSize
+            # a bigger window might mean we can send now
+            self.writeCondition.notify()
+        if not self.threaded:
+            self.poll()
+
+    def send_packet_upstream(self, packet, source=None):
         """ send binary packet via COBS encoding if upstream link """
-        d = cobs.encode(packet) + b'\x00'
+        d = hskframe.encode(packet)
         if self.transport:
             self.transport.write(d)
-        with self._statisticsLock:
-            self._sentPackets = self._sentPackets + 1
+        self.stats.add('sent')
+
+    def send_packet_downstream(self, packet, source=None):
+        """ queue binary packet for the write thread if downstream link """
+        self.logger.trace("forwarding packet to write thread")
+        with self.writeCondition:
+            ok = self.requestWindow.push(bytes(packet), source)
+            self.writeCondition.notify()
+        if not ok:
+            self.stats.add('dropped')
 
-    def send_packet_downstream(self, packet):
-        """ send binary packet via COBS encoding if downstream link """
-        d = cobs.encode(packet) + b'\x00'
-        if self.downstreamWriteFifo: 
-            self.logger.trace("forwarding packet to write thread")           
-            self.downstreamWriteFifo.put(d)
+    def send_packet_downstream_inline(self, packet, source=None):
+        """ send binary packet (or hold it) if downstream link and not threaded """
+        if not self.requestWindow.push(bytes(packet), source):
+            self.stats.add('dropped')
+        self.poll()
+
+    def poll(self):
+        """
+        Non-threaded version of the write thread: expire, send whatever
+        we can, and return the seconds until the next timeout (or None).
+        """
+        for dst in self.requestWindow.expire():
+            self.stats.add('timeouts')
+            self.onTimeout(dst)
+            self.logger.trace("%s: %s timed out", self.name, hex(dst))
+        while True:
+            n = self.requestWindow.next()
+            if n is None:
+                break
+            pkt, source, wait = n
+            self.stats.addWait(source, wait)
+            if self.transport:
+                self.transport.write(hskframe.encode(pkt))
+            self.stats.add('sent')
+        deadline = self.requestWindow.deadline()
+        if deadline is None:
+            return None
+        return max(deadline - time.monotonic(), 0)
 
     def downstream_thread_send_packet(self):
         """ Worker thread for cases where we send downstream. """
         self.logger.trace("%s write thread starting", self.name)
-        while not self.terminate:
-            try:
-                self.inPacketEvent.clear()
-                d = self.downstreamWriteFifo.get(timeout=1)
-                self.logger.trace("write thread: got packet to write to downstream")
-                if self.transport:
-                    self.transport.write(d)
-                with self._statisticsLock:
-                    self._sentPackets = self._sentPackets + 1
-                self.inPacketEvent.wait(0.1)
-                if self.inPacketEvent.is_set():
-                    self.logger.trace("write thread: got response")
-                else:
-                    self.logger.trace("write thread: timed out")
-            except queue.Empty:
-                pass
-                
-            
-    def statistics(self):
-        """ Get the packet statistics """
-        r = []
-        with self._statisticsLock:
-            r = [self._receivedPackets,
-                 self._sentPackets,
-                 self._errorPackets,
-                 self._droppedPackets ]
-        return list(map(self._mod, r))
+        while True:
+            with self.writeCondition:
+                if self.terminate:
+                    break
+                for dst in self.requestWindow.expire():
+                    self.stats.add('timeouts')
+                    self.onTimeout(dst)
+                    self.logger.trace("write thread: %s timed out", hex(dst))
+                n = self.requestWindow.next()
+                if n is None:
+                    deadline = self.requestWindow.deadline()
+                    timeout = 1 if deadline is None else deadline - time.monotonic()
+                    self.writeCondition.wait(max(timeout, 0))
+                    continue
+            pkt, source, wait = n
+            self.stats.addWait(source, wait)
+            self.logger.trace("write thread: got packet to write to downstream")
+            d = hskframe.encode(pkt)
+            if self.transport:
+                self.transport.write(d)
+            self.stats.add('sent')
 
+    def statistics(self):
+        """ Get the packet statistics (received, sent, errors, dropped, timeouts, broadcasts) """
+        return self.stats.values()
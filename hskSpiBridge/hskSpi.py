@@ -1,23 +1,64 @@
 from pathlib import Path
+import ctypes
+import fcntl
+import os
+import struct
 import spi
 from gpio import GPIO
 
+# Reads used to be chunk_size transfers with a sysfs poll of the
+# complete pin after every one, each with a fresh buffer. Now an
+# untilEmpty read starts with one burst_size transfer straight into a
+# buffer we keep around, and only falls back to chunks (checking the
+# pin) if the FIFO still isn't empty after that. There's no FIFO level
+# to ask for, so the burst can run past the end of what's there: the
+# FPGA clocks out zeros when it's empty, which are just frame
+# separators. Don't make it bigger than an upload packet (1024) though,
+# those are raw data.
+#
+# spi.SPI can't read into a buffer, so the reads are our own ioctl on
+# our own handle to the device. spidev keeps the mode and speed per
+# device, so what spi.SPI set up applies (0 = use it).
+# struct spi_ioc_transfer from linux/spi/spidev.h: tx_buf, rx_buf, len,
+# speed_hz, delay_usecs, bits_per_word, cs_change, tx_nbits, rx_nbits,
+# word_delay_usecs, pad
+SPI_IOC_TRANSFER = struct.Struct('=QQIIHBBBBBB')
+# SPI_IOC_MESSAGE(1) = _IOW('k', 0, char[sizeof(struct spi_ioc_transfer)])
+SPI_IOC_MESSAGE_1 = (1 << 30) | (SPI_IOC_TRANSFER.size << 16) | (ord('k') << 8)
+
 class HskRSPI(spi.SPI):
-    def __init__(self, path='/dev/spidev2.0', gpiopin=79, speed=30000000, chunk_size=32):
+    def __init__(self, path='/dev/spidev2.0', gpiopin=79, speed=30000000, chunk_size=32, burst_size=1024):
         super().__init__(path)
         self.mode = self.MODE_0
         self.bits_per_word = 8
         self.speed = speed
-        self.chunk_size = 32
+        self.chunk_size = chunk_size
+        self.burst_size = max(burst_size, chunk_size)
         self.pin = GPIO(GPIO.get_gpio_pin(2, gpio_type='EMIO'), direction='in')
+        self.fd = os.open(path, os.O_RDWR)
+        self._setBuffer(bytearray(self.burst_size))
+
+    def _setBuffer(self, buf):
+        self._cbuf = None
+        self.buf = buf
+        self._cbuf = (ctypes.c_char * len(buf)).from_buffer(buf)
+
+    def _readInto(self, offset, length):
+        """ clock length bytes into our buffer at offset (no tx buffer = send zeros) """
+        if offset + length > len(self.buf):
+            self._setBuffer(self.buf + bytearray(offset + length - len(self.buf)))
+        xfer = SPI_IOC_TRANSFER.pack(0, ctypes.addressof(self._cbuf) + offset,
+                                     length, 0, 0, 0, 0, 0, 0, 0, 0)
+        fcntl.ioctl(self.fd, SPI_IOC_MESSAGE_1, xfer)
 
     def read(self, untilEmpty=False):
-        r = bytearray()
-        r += self.transfer(b'\x00'*self.chunk_size)
+        n = self.burst_size if untilEmpty else self.chunk_size
+        self._readInto(0, n)
         if untilEmpty:
             while not self.complete:
-                r += self.transfer(b'\x00'*self.chunk_size)
-        return r
+                self._readInto(n, self.chunk_size)
+                n += self.chunk_size
+        return self.buf[:n]
         
     @property
     def complete(self):
@@ -47,9 +88,10 @@ class HskSPI():
                 return devname
         return None
 
-    def __init__(self, speed=30000000, chunk_size=32):
+    def __init__(self, speed=30000000, chunk_size=32, burst_size=1024):
         self.rspi = HskRSPI(self.spi_find_device('osu,turfhskRead'),
-                            speed=speed, chunk_size=chunk_size)
+                            speed=speed, chunk_size=chunk_size,
+                            burst_size=burst_size)
         self.wspi = HskWSPI(self.spi_find_device('osu,turfhskWrite'),
                             speed=speed)
         self.read = self.rspi.read
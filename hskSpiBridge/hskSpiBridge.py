@@ -9,11 +9,13 @@ from pathlib import Path
 import sys
 import configparser
 from rawpty import RawPTY
+import hskframe
 from signalhandler import SignalHandler
 
 # hskspi is hiding in our path, so fetch it
 sys.path.append(os.path.dirname(__file__))
 from hskSpi import HskSPI
+from uploadSink import UploadSink, ResumableSink
 
 EVENTPATH="/dev/input/by-path/platform-hsk-gpio-keys-event"
 LOG_NAME="hskSpi"
@@ -24,6 +26,11 @@ config = {}
 config['LogLevel'] = logging.WARNING
 config['HskPath'] = "/dev/hskspi"
 config['ChunkSize'] = 32
+config['BurstSize'] = 1024
+config['UploadBufferSize'] = 1<<20
+config['UploadProgressInterval'] = 1<<20
+config['UploadMaxWindow'] = 32
+config['UploadCheckpointInterval'] = 1<<20
 
 nm = DEFAULT_CONFIG_NAME
 if os.path.exists(CONFIG_NAME):
@@ -35,6 +42,11 @@ if os.path.exists(nm):
     config['LogLevel'] = parser.getint('hskSpiBridge', 'LogLevel', fallback=config['LogLevel'])
     config['HskPath'] = parser.get('hskSpiBridge', 'HskPath', fallback=config['HskPath'])
     config['ChunkSize'] = parser.getint('hskSpiBridge', 'ChunkSize', fallback=config['ChunkSize'])
+    config['BurstSize'] = parser.getint('hskSpiBridge', 'BurstSize', fallback=config['BurstSize'])
+    config['UploadBufferSize'] = parser.getint('hskSpiBridge', 'UploadBufferSize', fallback=config['UploadBufferSize'])
+    config['UploadProgressInterval'] = parser.getint('hskSpiBridge', 'UploadProgressInterval', fallback=config['UploadProgressInterval'])
+    config['UploadMaxWindow'] = parser.getint('hskSpiBridge', 'UploadMaxWindow', fallback=config['UploadMaxWindow'])
+    config['UploadCheckpointInterval'] = parser.getint('hskSpiBridge', 'UploadCheckpointInterval', fallback=config['UploadCheckpointInterval'])
 
 # https://stackoverflow.com/questions/2183233/how-to-add-a-custom-loglevel-to-pythons-logging-facility/35804945
 def addLoggingLevel(levelName, levelNum, methodName=None):
@@ -76,76 +88,299 @@ class Event:
             self.code = None
 
 PYFW = b'PYFW'
-TMPPATH="/tmp/pyfwupd.tmp"
+PYWF = b'PYWF'
+PYRF = b'PYRF'
+
+# Uploads come in two flavors, picked by the magic in the first packet.
+#
+# PYFW is the original: the header packet carries the first of the
+# data, every packet after it is a zero and then data, and each one gets
+# acked with a single byte packet count. The sender has to wait for
+# every ack, so it goes as fast as the round trip and no faster.
+#
+# PYWF is windowed: the header packet has a window size byte after the
+# checksum and no data. Data packets are a zero, a 15-bit sequence
+# number (with the top bit set, so a packet of zeroes is still a
+# reset), and WINDOWED_DATA bytes of data. The sender can have up to
+# window packets out, and every packet gets acked with the next
+# sequence number we need (same encoding), the window, and a bitmap of
+# the packets after it we already have (bit 0 of the first byte is
+# that next one, so it's always clear). The sender only resends what's
+# missing. Packets that show up ahead of a hole get held until it's
+# filled, so the file and its MD5 still go in order.
+#
+# PYRF is windowed and resumable (see ResumableSink). The header has
+# the window byte and then the file's 16-byte MD5. Data packets are a
+# zero, a 23-bit chunk number (top bit set again) and RESUMABLE_DATA
+# bytes of data, and they can come in any order. Acks are the first
+# chunk we don't have (4 bytes), the window, and a bitmap of the window
+# after it like PYWF. The ack to the header also has a count and then
+# (first chunk, count) of every hole, 4 bytes each, up to MAX_RANGES of
+# them: that's the list to send. Sending the header again asks for it
+# again. A reset or a dropped link keeps what we have, and the same
+# header (file, length, MD5) picks it back up, even after a restart.
+UPLOAD_PACKET = 1024
+WINDOWED_DATA = UPLOAD_PACKET - 3
+RESUMABLE_DATA = UPLOAD_PACKET - 4
+MAX_RANGES = 32
+bmSeq = 0x8000
 
 class UploadHandler:
-    def __init__(self, l, h):
+    def __init__(self, l, h, bufferSize=1<<20, progressInterval=1<<20, maxWindow=32,
+                 checkpointInterval=1<<20):
         self.logger = l
         self.handler = h
+        self.bufferSize = bufferSize
+        self.progressInterval = progressInterval
+        self.maxWindow = maxWindow
+        self.checkpointInterval = checkpointInterval
         self.pktno = 0
+        # the UploadSink for the file in progress
         self.curFile = None
-        self.tmpPath = Path(TMPPATH)
-        self.NULL = bytes(32)
-        if self.tmpPath.exists():
-            self.tmpPath.unlink()
-        self.tempFile = open(self.tmpPath, "w+b")
-        
+        # windowed: 0 if not, otherwise the window size
+        self.window = 0
+        self.nextSeq = 0
+        # seq : data for packets past a hole
+        self.ahead = {}
+        # the last ack of a finished windowed upload, in case the sender missed it
+        self.finalAck = None
+
+    def abandon(self):
+        if self.curFile:
+            self.logger.info(f'upload: abandoning file {self.curFile.path}')
+            self.curFile.abort()
+            self.curFile = None
+        self.window = 0
+        self.ahead = {}
+
+    def close(self):
+        """ on the way out: a resumable upload keeps what it has """
+        if isinstance(self.curFile, ResumableSink):
+            self.curFile.close()
+            self.curFile = None
+
+    def resumableAck(self, ranges=False):
+        f = self.curFile
+        nxt = f.hashed
+        bitmap = bytearray((self.window+7)//8)
+        for off in range(1, min(self.window, f.nchunks - nxt)):
+            if f.have(nxt + off):
+                bitmap[off//8] |= 1 << (off % 8)
+        ack = struct.pack(">IB", nxt, self.window) + bitmap
+        if ranges:
+            holes = f.missing(MAX_RANGES)
+            ack += bytes([len(holes)])
+            for first, n in holes:
+                ack += struct.pack(">II", first, n)
+        return ack
+
+    def windowAck(self):
+        bitmap = bytearray((self.window+7)//8)
+        for seq in self.ahead:
+            off = seq - self.nextSeq
+            bitmap[off//8] |= 1 << (off % 8)
+        return struct.pack(">HB", bmSeq | (self.nextSeq & 0x7FFF), self.window) + bitmap
+
+    def write(self, r, seq=None):
+        """ write to the file in progress, finishing it if that was all of it. False if it failed """
+        try:
+            # the last packet's padded out, the sink only takes what's left
+            if seq is None:
+                self.curFile.write(r)
+            else:
+                self.curFile.write(seq, r)
+        except Exception as e:
+            """ also bad """
+            self.logger.error('upload: Writing to file failed: ' + repr(e))
+            self.handler.set_terminate()
+            return False
+        if not self.curFile.remaining:
+            return self.finishFile()
+        return True
+
+    def finishFile(self):
+        try:
+            md5 = self.curFile.finish()
+            self.logger.file(f'upload: completed {self.curFile.path} length {self.curFile.length} '
+                             f'md5sum {md5} at {self.curFile.rate()/1024:.1f} kB/s')
+        except ValueError as e:
+            # a resumable upload with the wrong MD5: it's gone, they start over
+            self.logger.error('upload: ' + str(e))
+            self.curFile = None
+            self.window = 0
+            return False
+        except Exception as e:
+            """ this is bad """
+            self.logger.error('upload: Finishing file failed: ' + repr(e))
+            self.handler.set_terminate()
+            return False
+        self.curFile = None
+        return True
+
+    def handleHeader(self, r):
+        # we don't need PYEXs in the TURF
+        magic = bytes(r[1:5])
+        if magic not in (PYFW, PYWF, PYRF):
+            self.logger.error(f'comm error: first packet {r[1:5].hex()}')
+            return None
+        self.logger.debug(f'upload: {magic.decode()} okay, unpacking header')
+        thisLen = struct.unpack(">I", r[5:9])[0]
+        endFn = r[9:].index(b'\x00')+9
+        thisFn = r[13:endFn].decode()
+        cks = sum(r[:endFn+2]) % 256
+        if cks != 0:
+            self.logger.error(f'upload: checksum failed: {r[:endFn+2].hex()}')
+            return None
+        if magic == PYWF and isinstance(self.curFile, UploadSink) and self.window and \
+           str(self.curFile.path) == thisFn and self.curFile.length == thisLen:
+            # they didn't see our ack to the header, it's not a new upload
+            return self.windowAck()
+        if magic == PYRF:
+            return self.startResumable(thisFn, thisLen, r[endFn+2], r[endFn+3:endFn+19])
+        self.abandon()
+        self.finalAck = None
+        self.logger.info(f'upload: beginning {thisFn} length {thisLen}')
+        try:
+            self.curFile = UploadSink(thisFn, thisLen, self.logger,
+                                      bufferSize=self.bufferSize,
+                                      progressInterval=self.progressInterval)
+        except Exception as e:
+            self.logger.error(f'upload: can\'t create {thisFn}: {e!r}')
+            return None
+        if magic == PYWF:
+            self.window = max(1, min(r[endFn+2], self.maxWindow))
+            self.nextSeq = 0
+            self.logger.info(f'upload: windowed, window {self.window}')
+            if not thisLen:
+                return self.finishWindowed()
+            return self.windowAck()
+        if not self.write(r[endFn+2:]):
+            return None
+        self.pktno = (self.pktno + 1) & 0xFF
+        return bytes([self.pktno])
+
+    def startResumable(self, thisFn, thisLen, window, md5):
+        f = self.curFile
+        if not (isinstance(f, ResumableSink) and str(f.path) == thisFn and
+                f.length == thisLen and f.expected == md5):
+            self.abandon()
+            self.finalAck = None
+            self.logger.info(f'upload: beginning {thisFn} length {thisLen} md5 {bytes(md5).hex()}, resumable')
+            try:
+                self.curFile = ResumableSink(thisFn, thisLen, md5, RESUMABLE_DATA, self.logger,
+                                             checkpointInterval=self.checkpointInterval,
+                                             progressInterval=self.progressInterval)
+            except Exception as e:
+                self.logger.error(f'upload: can\'t create {thisFn}: {e!r}')
+                return None
+        self.window = max(1, min(window, self.maxWindow))
+        if self.curFile.done:
+            # had it all already
+            f = self.curFile
+            if not self.finishFile():
+                return None
+            return self.resumableDone(f.nchunks)
+        return self.resumableAck(ranges=True)
+
+    def resumableDone(self, nchunks):
+        self.finalAck = struct.pack(">IB", nchunks, self.window) + bytes((self.window+7)//8)
+        self.window = 0
+        return self.finalAck
+
+    def handleResumable(self, r):
+        seq = (r[1] & 0x7F) << 16 | r[2] << 8 | r[3]
+        f = self.curFile
+        if not self.write(r[4:4+RESUMABLE_DATA], seq):
+            return None
+        if self.curFile is None:
+            return self.resumableDone(f.nchunks)
+        return self.resumableAck()
+
+    def finishWindowed(self):
+        if self.curFile and not self.write(b''):
+            return None
+        self.ahead = {}
+        self.finalAck = self.windowAck()
+        self.window = 0
+        return self.finalAck
+
+    def handleWindowed(self, r):
+        off = ((r[1] << 8 | r[2]) - self.nextSeq) & 0x7FFF
+        if off < self.window:
+            if off:
+                self.ahead[self.nextSeq + off] = bytes(r[3:3+WINDOWED_DATA])
+            else:
+                data = r[3:3+WINDOWED_DATA]
+                while data is not None:
+                    if not self.write(data):
+                        return None
+                    self.nextSeq += 1
+                    if self.curFile is None:
+                        return self.finishWindowed()
+                    data = self.ahead.pop(self.nextSeq, None)
+        # anything else is a resend of something we already have
+        return self.windowAck()
+
     def handleUploadPacket(self, r):
-        if r == self.NULL:
+        """ returns the ack to send back, or None if it was garbage """
+        if not any(r):
             self.logger.file(f'upload: reset/separator')
-            # A 32-byte chunk of nothing but zeroes is a separator/reset.
+            # A read of nothing but zeroes is a separator/reset.
             # Note that in the uploader we avoid triggering this by
             # making sure that all packets are 1024 bytes, and letting
-            # the completion trim it.            
-            if self.curFile:
-                self.logger.info(f'upload: abandoning file {curFile[0]}')
-                self.tempFile.close()
-                self.tempFile = open(self.tmpPath, "w+b")
+            # the completion trim it.
+            self.abandon()
             self.pktno = 0
-            return self.pktno        
-        if self.curFile is None:
-            # we don't need PYEXs in the TURF
-            if r[1:5] != PYFW:
-                self.logger.error(f'comm error: first packet {r[1:5].hex()}')
-                return None
-            self.logger.debug('upload: PYFW okay, unpacking header')
-            thisLen = struct.unpack(">I", r[5:9])[0]
-            endFn = r[9:].index(b'\x00')+9
-            thisFn = r[13:endFn].decode()
-            cks = sum(r[:endFn+2]) % 256
-            if cks != 0:
-                self.logger.error(f'upload: checksum failed: {r[:endFn+2].hex()}')
+            return bytes([self.pktno])
+        if self.curFile and not self.window:
+            if not self.write(r[1:]):
                 return None
-            self.logger.info(f'upload: beginning {thisFn} length {thisLen}')
-            self.curFile = [ thisFn, thisLen ] 
-            r = r[endFn+2:]
-        else:
-            r = r[1:]
-        if len(r) > self.curFile[1]:
-            try:
-                self.tempFile.write(r[:self.curFile[1]])
-                self.tempFile.close()
-                shutil.move(self.tmpPath, self.curFile[0])
-                md5 = filemd5(self.curFile[0])
-                self.logger.file(f'upload: completed {self.curFile[0] : md5sum {md5}}')
-                self.tempFile = open(self.tmpPath, "w+b")
-            except Exception as e:
-                """ this is bad """
-                self.logger.error('upload: Finishing file failed: ' + repr(e))
-                self.handler.set_terminate()
-                return None
-            self.curFile = None
-        else:
-            try:
-                self.tempFile.write(r)
-            except Exception as e:
-                """ also bad """
-                self.logger.error('upload: Writing to file failed: ' + repr(e))
-                self.handler.set_terminate()
-                return None
-        self.pktno = (self.pktno + 1) & 0xFF
-        return self.pktno
+            self.pktno = (self.pktno + 1) & 0xFF
+            return bytes([self.pktno])
+        if r[1] & (bmSeq >> 8):
+            if isinstance(self.curFile, ResumableSink):
+                return self.handleResumable(r)
+            if self.curFile:
+                return self.handleWindowed(r)
+            if self.finalAck:
+                return self.finalAck
+            self.logger.error('upload: windowed packet without an upload')
+            return None
+        return self.handleHeader(r)
                                     
+# handle uploads. uploads are indicated by null starting bytes
+# and acked by the upload packet count
+# you bound stuff by any housekeeping packet
+# so like ePingPong/upload/ePingPong/upload/etc.
+#
+# A zero right after an unfinished frame from the last read is either
+# its terminator or the start of an upload (the SFC doesn't start one
+# in the middle of a packet). It's only a terminator if what we've got
+# is a whole packet: otherwise it's the leftovers of a truncated frame,
+# and those get thrown away instead of eating the upload.
+def handleRead(r, framer, upload, logger):
+    """ one interrupt's read. returns (upload ack to send back or None, frames for the router) """
+    if r[0] == 0 and framer.partial:
+        dec, skipped = hskframe.decode(framer.partial)
+        err = "COBS decode error" if dec is None else hskframe.check(dec)
+        if err:
+            logger.error(f'{err}: dropping unfinished frame {framer.partial.hex(sep=" ")}')
+            framer.partial.clear()
+    if r[0] == 0 and not framer.partial:
+        ack = upload.handleUploadPacket(r)
+        if ack is None:
+            logger.error('weird upload packet discarded')
+        return ack, b''
+    # the router checks them (and counts the bad ones against SFC)
+    out = bytearray()
+    n = 0
+    for pkt in framer.feed(r):
+        out += pkt
+        out.append(0)
+        n += 1
+    logger.trace(f'found {n} packets, forwarding')
+    return None, out
+
 if __name__ == "__main__":
     addLoggingLevel('TRACE', logging.DEBUG - 5)
     addLoggingLevel('DETAIL', logging.INFO - 5)
@@ -154,7 +389,8 @@ if __name__ == "__main__":
     logging.basicConfig(level=config['LogLevel'])
     
     # get the SPI device
-    dev = HskSPI(chunk_size=config['ChunkSize'])
+    dev = HskSPI(chunk_size=config['ChunkSize'],
+                 burst_size=config['BurstSize'])
     # set the upload count to zero
     dev.upload_count = 0
     
@@ -165,11 +401,19 @@ if __name__ == "__main__":
     handler = SignalHandler(sel)
 
     # create the upload handler
-    upload = UploadHandler(logger, handler)
+    upload = UploadHandler(logger, handler,
+                           bufferSize=config['UploadBufferSize'],
+                           progressInterval=config['UploadProgressInterval'],
+                           maxWindow=config['UploadMaxWindow'],
+                           checkpointInterval=config['UploadCheckpointInterval'])
     
     # create pty.
     pty = RawPTY(wellKnownName=config['HskPath'])
 
+    # frames can straddle reads, so the framer holds on to the
+    # unfinished one until the next read finishes it
+    framer = hskframe.Framer()
+
     with open(EVENTPATH, "rb") as evf:
         def handleDownstream(f, m):
             logger.info("downstream packet available: reading")
@@ -190,22 +434,11 @@ if __name__ == "__main__":
                     logger.info("upstream packet available: reading")
                     r = dev.read(untilEmpty=True)
                     logger.trace(f'read {len(r)} bytes')
-                    # handle uploads. uploads are indicated by null starting bytes
-                    # and acked by the upload packet count
-                    # you bound stuff by any housekeeping packet
-                    # so like ePingPong/upload/ePingPong/upload/etc.
-                    if r[0] == 0:
-                        r = upload.handleUploadPacket(r)
-                        if r is not None:
-                            dev.write(r.to_bytes(1, 'big'))
-                            return
-                        else:
-                            logger.error('weird upload packet discarded')
-                            return
-                    pkts = list(filter(None, r.split(b'\x00')))
-                    logger.trace(f'found {len(pkts)} packets, forwarding')
-                    for pkt in pkts:
-                        os.write(pty.pty, pkt+b'\x00')
+                    ack, out = handleRead(r, framer, upload, logger)
+                    if ack is not None:
+                        dev.write(ack)
+                    if out:
+                        os.write(pty.pty, out)
                 elif e.code == 30 and e.value == 0:
                     logger.trace("received read complete notification")
 
@@ -218,4 +451,6 @@ if __name__ == "__main__":
                 callback = key.data
                 callback(key.fileobj, mask)
 
+    # keep whatever a resumable upload's gotten so far
+    upload.close()
     logger.info("exiting")
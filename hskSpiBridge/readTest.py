@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# Checks for how the bridge sorts out what it reads from the SFC
+# (handleRead), no hardware needed. Needs the same modules the bridge
+# does (spi, gpio, signalhandler...) on the path.
+import logging
+import os
+import struct
+import sys
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import hskframe
+import hskSpiBridge
+from hskSpiBridge import handleRead, UploadHandler, UPLOAD_PACKET
+
+hskSpiBridge.addLoggingLevel('TRACE', logging.DEBUG - 5)
+hskSpiBridge.addLoggingLevel('FILE', 100)
+logger = logging.getLogger(hskSpiBridge.LOG_NAME)
+
+class Handler:
+    def set_terminate(self):
+        raise AssertionError('bridge asked to terminate')
+
+def pyfwHeader(path, data):
+    """ a one packet PYFW upload of data to path """
+    hdr = bytearray(b'\x00PYFW') + struct.pack('>I', len(data)) + b'xxxx' + path.encode() + b'\x00'
+    hdr.append((256 - sum(hdr)) & 0xFF)
+    hdr += data
+    return bytes(hdr) + bytes(UPLOAD_PACKET - len(hdr))
+
+def ping(src=0x12, dst=0x40):
+    return hskframe.encode(bytes([src, dst, 0, 0, 0]))
+
+def testTruncatedThenUpload(tmp):
+    framer = hskframe.Framer()
+    upload = UploadHandler(logger, Handler())
+    # the tail of a read that got cut off mid-frame
+    ack, out = handleRead(b'\x03\x01\x02', framer, upload, logger)
+    assert ack is None and not out and framer.partial
+    path = os.path.join(tmp, 'up.bin')
+    ack, out = handleRead(pyfwHeader(path, b'0123456789'), framer, upload, logger)
+    assert ack == bytes([1]), ack
+    assert not out and not framer.partial
+    with open(path, 'rb') as f:
+        assert f.read() == b'0123456789'
+
+def testSplitAtTerminator(tmp):
+    framer = hskframe.Framer()
+    upload = UploadHandler(logger, Handler())
+    frame = ping()
+    # a whole packet, and its terminator comes in the next read
+    ack, out = handleRead(frame[:-1], framer, upload, logger)
+    assert ack is None and not out
+    ack, out = handleRead(b'\x00' + ping(dst=0x41), framer, upload, logger)
+    assert ack is None
+    assert bytes(out) == frame + ping(dst=0x41), out.hex()
+
+def testSplitMidFrame(tmp):
+    framer = hskframe.Framer()
+    upload = UploadHandler(logger, Handler())
+    frame = ping()
+    handleRead(frame[:3], framer, upload, logger)
+    ack, out = handleRead(frame[3:] + bytes(16), framer, upload, logger)
+    assert ack is None and bytes(out) == frame
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as tmp:
+        for nm, fn in list(globals().items()):
+            if nm.startswith('test'):
+                fn(tmp)
+                print(f'{nm}: ok')
@@ -0,0 +1,247 @@
+import hashlib
+import os
+import struct
+import time
+from pathlib import Path
+
+# Where an upload's data goes as it comes in.
+#
+# Uploads used to go to a temp file in /tmp (which is RAM) one small
+# write per SPI read, then get read back for the MD5 and moved into
+# place. Now the data goes into a .part file next to the destination,
+# preallocated to the full length so the filesystem can say no up
+# front, through a big write buffer, and the MD5 gets updated as it
+# goes. Finishing is a size check and a rename.
+class UploadSink:
+    def __init__(self, path, length, logger, bufferSize=1<<20, progressInterval=1<<20):
+        """
+        path : where the file ends up
+        length : how many bytes are coming
+        bufferSize : write buffer size
+        progressInterval : log progress every this many bytes
+        """
+        self.path = Path(path)
+        self.tmpPath = self.path.with_name(self.path.name + '.part')
+        self.length = length
+        self.logger = logger
+        self.progressInterval = progressInterval
+        self.received = 0
+        self.nextProgress = progressInterval
+        self.md5 = hashlib.md5()
+        fd = os.open(self.tmpPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.posix_fallocate(fd, 0, length)
+        except OSError as e:
+            # not every filesystem can, the write will fail if it's full anyway
+            self.logger.debug(f'upload: can\'t preallocate {self.tmpPath}: {e!r}')
+        self.file = os.fdopen(fd, 'wb', buffering=bufferSize)
+        self.start = time.monotonic()
+
+    @property
+    def remaining(self):
+        return self.length - self.received
+
+    def rate(self):
+        """ bytes/second so far """
+        dt = time.monotonic() - self.start
+        return self.received/dt if dt > 0 else 0.0
+
+    def write(self, data):
+        """ take as much of data as still fits. returns how much that was """
+        data = data[:self.remaining]
+        self.file.write(data)
+        self.md5.update(data)
+        self.received += len(data)
+        if self.received >= self.nextProgress:
+            self.nextProgress += self.progressInterval
+            self.logger.info(f'upload: {self.path.name} {self.received}/{self.length} bytes '
+                             f'({100*self.received//max(self.length, 1)}%) at {self.rate()/1024:.1f} kB/s')
+        return len(data)
+
+    def finish(self):
+        """ check it and move it into place. returns the md5 hex digest """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        size = os.stat(self.tmpPath).st_size
+        if size != self.length or self.received != self.length:
+            raise ValueError(f'{self.tmpPath} is {size} bytes, got {self.received}, expected {self.length}')
+        os.replace(self.tmpPath, self.path)
+        return self.md5.hexdigest()
+
+    def abort(self):
+        self.file.close()
+        self.tmpPath.unlink(missing_ok=True)
+
+# A resumable upload (PYRF) goes into a sparse .part file, chunk by
+# chunk wherever each one belongs, and a .map file next to it keeps
+# which chunks we have along with what the upload is (length, chunk
+# size and MD5). If the link drops or we get restarted, the next
+# upload of the same file with the same length and MD5 picks up where
+# this one left off, and the sender only has to fill in the holes.
+#
+# The map only gets written after the data's been synced, every
+# checkpointInterval bytes and when we let go of the upload, so it
+# never claims something that didn't make it to disk. The MD5 runs over
+# the contiguous part from the start, so chunks that arrive out of
+# order (or were there from before) get read back once when it
+# catches up to them. The MD5 has to match to finish.
+class ResumableSink:
+    MAGIC = b'PYRFMAP\x00'
+    HEADER = struct.Struct('>8sIH16s')
+    def __init__(self, path, length, md5, chunkSize, logger, checkpointInterval=1<<20, progressInterval=1<<20):
+        """
+        path : where the file ends up
+        length : how many bytes it is
+        md5 : its MD5 digest (16 bytes)
+        chunkSize : data bytes per chunk
+        checkpointInterval : sync and write the map every this many bytes
+        progressInterval : log progress every this many bytes
+        """
+        self.path = Path(path)
+        self.tmpPath = self.path.with_name(self.path.name + '.part')
+        self.mapPath = self.path.with_name(self.path.name + '.map')
+        self.length = length
+        self.expected = bytes(md5)
+        self.chunkSize = chunkSize
+        self.logger = logger
+        self.checkpointInterval = checkpointInterval
+        self.progressInterval = progressInterval
+        self.nchunks = -(-length // chunkSize)
+        self.bitmap = bytearray((self.nchunks+7)//8)
+        self.received = 0
+        if self._load():
+            self.fd = os.open(self.tmpPath, os.O_RDWR)
+            self.logger.info(f'upload: resuming {self.path}, have {self.received}/{self.length} bytes')
+        else:
+            self.fd = os.open(self.tmpPath, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            # sparse: nothing gets allocated until it's written
+            os.ftruncate(self.fd, length)
+            self._writeMap()
+        self.unsynced = 0
+        self.nextProgress = self.received + progressInterval
+        self.start = time.monotonic()
+        self.startReceived = self.received
+        self.md5 = hashlib.md5()
+        # chunks hashed so far, i.e. the first one we don't have
+        self.hashed = 0
+        self._catchUp()
+
+    def _load(self):
+        """ pick up the map from last time if it's for this upload """
+        try:
+            buf = self.mapPath.read_bytes()
+            magic, length, chunkSize, md5 = self.HEADER.unpack_from(buf)
+        except (OSError, struct.error):
+            return False
+        if magic != self.MAGIC or length != self.length or chunkSize != self.chunkSize or \
+           md5 != self.expected or len(buf) != self.HEADER.size + len(self.bitmap) or \
+           not self.tmpPath.exists() or self.tmpPath.stat().st_size != self.length:
+            self.logger.info(f'upload: {self.mapPath} is for a different upload, starting over')
+            return False
+        self.bitmap[:] = buf[self.HEADER.size:]
+        self.received = sum(self.chunkLength(i) for i in range(self.nchunks) if self.have(i))
+        return True
+
+    def _writeMap(self):
+        tmp = self.mapPath.with_name(self.mapPath.name + '.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.length, self.chunkSize, self.expected))
+            f.write(self.bitmap)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.mapPath)
+
+    def checkpoint(self):
+        """ sync the data, then record that we have it """
+        os.fsync(self.fd)
+        self._writeMap()
+        self.unsynced = 0
+
+    def chunkLength(self, seq):
+        return min(self.chunkSize, self.length - seq*self.chunkSize)
+
+    def have(self, seq):
+        return bool(self.bitmap[seq >> 3] & (1 << (seq & 7)))
+
+    @property
+    def remaining(self):
+        return self.length - self.received
+
+    @property
+    def done(self):
+        return self.hashed == self.nchunks
+
+    def rate(self):
+        """ bytes/second received this time around """
+        dt = time.monotonic() - self.start
+        return (self.received - self.startReceived)/dt if dt > 0 else 0.0
+
+    def _catchUp(self, seq=None, data=None):
+        while self.hashed < self.nchunks and self.have(self.hashed):
+            if self.hashed == seq:
+                self.md5.update(data)
+            else:
+                self.md5.update(os.pread(self.fd, self.chunkLength(self.hashed),
+                                         self.hashed*self.chunkSize))
+            self.hashed += 1
+
+    def write(self, seq, data):
+        """ chunk seq's data (padding gets trimmed). duplicates and junk past the end are ignored """
+        if seq >= self.nchunks or self.have(seq):
+            return
+        data = data[:self.chunkLength(seq)]
+        os.pwrite(self.fd, data, seq*self.chunkSize)
+        self.bitmap[seq >> 3] |= 1 << (seq & 7)
+        self.received += len(data)
+        self.unsynced += len(data)
+        if self.unsynced >= self.checkpointInterval:
+            self.checkpoint()
+        if self.received >= self.nextProgress:
+            self.nextProgress += self.progressInterval
+            self.logger.info(f'upload: {self.path.name} {self.received}/{self.length} bytes '
+                             f'({100*self.received//max(self.length, 1)}%) at {self.rate()/1024:.1f} kB/s')
+        self._catchUp(seq, data)
+
+    def missing(self, limit=None):
+        """ (first chunk, count) of every hole, up to limit of them """
+        ranges = []
+        seq = self.hashed
+        while seq < self.nchunks and (limit is None or len(ranges) < limit):
+            if self.have(seq):
+                seq += 1
+                continue
+            first = seq
+            while seq < self.nchunks and not self.have(seq):
+                seq += 1
+            ranges.append((first, seq - first))
+        return ranges
+
+    def finish(self):
+        """ check the MD5 and move it into place. returns the md5 hex digest """
+        os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+        if self.md5.digest() != self.expected:
+            self.discard()
+            raise ValueError(f'{self.path} md5 {self.md5.hexdigest()} expected {self.expected.hex()}')
+        os.replace(self.tmpPath, self.path)
+        self.mapPath.unlink(missing_ok=True)
+        return self.md5.hexdigest()
+
+    def close(self):
+        """ let go, keeping what we have for next time """
+        if self.fd is not None:
+            self.checkpoint()
+            os.close(self.fd)
+            self.fd = None
+
+    def abort(self):
+        self.close()
+
+    def discard(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.tmpPath.unlink(missing_ok=True)
+        self.mapPath.unlink(missing_ok=True)
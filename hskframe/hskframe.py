@@ -0,0 +1,216 @@
+from cobs import cobs
+import struct
+
+# Shared framing for housekeeping packets.
+#
+# A housekeeping packet is src, dst, cmd, len, data[len], cksum, with
+# the data+cksum summing to zero mod 256. On the wire it's COBS encoded
+# and terminated with a zero byte.
+#
+# Everyone used to do this themselves, and the COBS recovery for a
+# frame with leading garbage just chopped off one byte at a time and
+# retried the decode, which is O(n^2). A valid COBS frame is a chain of
+# code bytes where each one points at the next and the last one points
+# exactly at the end, so we can find every valid starting point in one
+# pass from the back. The first one is the longest valid suffix.
+
+# src, dst, cmd, len, cksum
+MIN_LENGTH = 5
+# encoded size of the smallest packet (one overhead byte)
+MIN_FRAME = MIN_LENGTH + 1
+
+def encode(pkt):
+    """ COBS encode pkt and add the terminator """
+    return cobs.encode(pkt) + b'\x00'
+
+def resync(frame, minSize=MIN_FRAME):
+    """
+    Find where the longest valid COBS frame that's a suffix of frame
+    starts, skipping at least one byte. Returns the offset or None.
+    """
+    n = len(frame)
+    if n - 1 < minSize:
+        return None
+    # valid[i] : the code chain starting at i lands exactly on n
+    valid = bytearray(n+1)
+    valid[n] = 1
+    start = None
+    for i in range(n-1, 0, -1):
+        nxt = i + frame[i]
+        if frame[i] and nxt <= n and valid[nxt]:
+            valid[i] = 1
+            if n - i >= minSize:
+                start = i
+    return start
+
+def decode(frame):
+    """
+    COBS decode frame (without its terminator). If it doesn't decode,
+    resynchronize past any leading garbage. Returns (pkt, skipped), where
+    pkt is None if nothing in there was valid.
+    """
+    try:
+        return cobs.decode(frame), 0
+    except cobs.DecodeError:
+        pass
+    start = resync(frame)
+    if start is None:
+        return None, 0
+    # the chain is valid so this can't fail
+    return cobs.decode(frame[start:]), start
+
+class Framer:
+    """
+    Splits a byte stream into frames at the zero terminators, keeping
+    a frame that isn't finished yet around for the next feed, so a
+    frame split across two reads still comes out whole.
+    """
+    def __init__(self, maxFrame=1024):
+        """
+        maxFrame : an unfinished frame longer than this is garbage and gets thrown away
+        """
+        self.maxFrame = maxFrame
+        self.partial = bytearray()
+        self.overflows = 0
+
+    def feed(self, data):
+        """ yields every frame data finishes (without terminators), skipping empty ones """
+        # the FPGA pads reads with zeros, don't walk through all of them
+        body = data.rstrip(b'\x00')
+        terminated = len(body) < len(data)
+        start = 0
+        end = body.find(0)
+        if self.partial and end < 0 and not terminated:
+            self.partial += body
+            if len(self.partial) > self.maxFrame:
+                self.overflows += 1
+                self.partial.clear()
+            return
+        if self.partial:
+            if end < 0:
+                end = len(body)
+            self.partial += body[:end]
+            frame = bytes(self.partial)
+            self.partial.clear()
+            yield frame
+            start = end + 1
+            end = body.find(0, start)
+        while end >= 0:
+            if end > start:
+                yield body[start:end]
+            start = end + 1
+            end = body.find(0, start)
+        if start < len(body):
+            if terminated:
+                yield body[start:]
+            else:
+                self.partial += body[start:]
+                if len(self.partial) > self.maxFrame:
+                    self.overflows += 1
+                    self.partial.clear()
+
+def check(pkt):
+    """ Check the length and checksum of a decoded packet. Returns None if OK, or what's wrong. """
+    pktLen = len(pkt)
+    if pktLen < MIN_LENGTH:
+        return "Packet too short"
+    if pkt[3] != pktLen-5:
+        return "Length of data (%d) doesn't match expected" % (pktLen-5)
+    if sum(memoryview(pkt)[4:]) % 256:
+        return "Invalid checksum"
+    return None
+
+# Fragmented transfers.
+#
+# The length byte caps a packet at 255 data bytes, so anything bigger
+# (journal output, eye scan results) goes as a train of fragments.
+# The requester starts a transfer by sending an ack for fragment 0 of
+# the command it wants, with that command's request data after the ack
+# header. The responder sends back up to window fragments and waits for
+# the next ack, which asks for the next window starting from the first
+# fragment the requester is missing (so lost fragments just get asked
+# for again). An ack past the last fragment ends the transfer, and
+# gets echoed back so every ack has an answer. A plain request whose
+# response turns out to be too big gets the first window back the
+# same way, and the requester acks from there.
+#
+# fragment : cmd kFragmentCmd, data = cmd, flags, seq, total length, data
+# ack      : cmd kFragmentAckCmd, data = cmd, next seq, window, request data
+#
+# The last fragment of each window has bmWindowEnd set, so the router
+# knows when the requester's turn is.
+
+kFragmentCmd = 0xFC
+kFragmentAckCmd = 0xFB
+bmWindowEnd = 0x1
+FRAGMENT_HEADER = struct.Struct('>BBHI')
+FRAGMENT_DATA = 255 - FRAGMENT_HEADER.size
+ACK_HEADER = struct.Struct('>BHB')
+DEFAULT_WINDOW = 4
+
+def _packet(src, dst, cmd, data):
+    pkt = bytearray([src, dst, cmd, len(data)])
+    pkt += data
+    pkt.append((256 - sum(data)) & 0xFF)
+    return pkt
+
+def fragmentCount(total):
+    """ number of fragments for total bytes (an empty transfer is one empty fragment) """
+    return max(1, -(-total // FRAGMENT_DATA))
+
+def fragment(src, dst, cmd, data, seq, windowEnd=False):
+    """ fragment seq of data (the whole thing) as a packet """
+    chunk = data[seq*FRAGMENT_DATA:(seq+1)*FRAGMENT_DATA]
+    flags = bmWindowEnd if windowEnd else 0
+    return _packet(src, dst, kFragmentCmd,
+                   FRAGMENT_HEADER.pack(cmd, flags, seq, len(data)) + chunk)
+
+def ack(src, dst, cmd, nextSeq, window=DEFAULT_WINDOW, data=b''):
+    """ ack asking for window fragments of cmd starting at nextSeq """
+    return _packet(src, dst, kFragmentAckCmd,
+                   ACK_HEADER.pack(cmd, nextSeq, window) + bytes(data))
+
+def parseFragment(pkt):
+    """ (cmd, flags, seq, total length, data) of a fragment packet, or None """
+    if pkt[2] != kFragmentCmd or pkt[3] < FRAGMENT_HEADER.size:
+        return None
+    return FRAGMENT_HEADER.unpack_from(pkt, 4) + (bytes(pkt[4+FRAGMENT_HEADER.size:-1]),)
+
+def parseAck(pkt):
+    """ (cmd, next seq, window, request data) of an ack packet, or None """
+    if pkt[2] != kFragmentAckCmd or pkt[3] < ACK_HEADER.size:
+        return None
+    return ACK_HEADER.unpack_from(pkt, 4) + (bytes(pkt[4+ACK_HEADER.size:-1]),)
+
+def isWindowEnd(pkt):
+    """ pkt is a fragment and the requester gets to ack after it """
+    return pkt[2] == kFragmentCmd and pkt[3] > 1 and bool(pkt[5] & bmWindowEnd)
+
+class FragmentSender:
+    """ the responder's side: one transfer per (requester, cmd) """
+    def __init__(self, myID):
+        self.myID = myID
+        # (requester, cmd) : data
+        self.transfers = {}
+
+    def start(self, dst, cmd, data, window=DEFAULT_WINDOW):
+        """ start sending data to dst as the response to cmd. returns the first window """
+        self.transfers[(dst, cmd)] = bytes(data)
+        return self.send(dst, cmd, 0, window)
+
+    def send(self, dst, cmd, nextSeq, window=DEFAULT_WINDOW):
+        """
+        packets for the window starting at nextSeq. Past the end the
+        transfer is over and you get the echo of the ack. None if
+        there's no transfer.
+        """
+        data = self.transfers.get((dst, cmd))
+        if data is None:
+            return None
+        n = fragmentCount(len(data))
+        if nextSeq >= n:
+            del self.transfers[(dst, cmd)]
+            return [ ack(self.myID, dst, cmd, nextSeq, 0) ]
+        last = min(nextSeq + max(window, 1), n)
+        return [ fragment(self.myID, dst, cmd, data, seq, seq == last-1)
+                 for seq in range(nextSeq, last) ]
@@ -42,6 +42,8 @@ if os.path.exists(nm):
     # we can grab the general ones ourselves
     generalConfig['LogLevel'] = parser.getint('General', 'LogLevel', fallback=logging.WARNING)
     generalConfig['EndState'] = parser.getint('General', 'EndState', fallback=TurfStartupHandler.StartupState.STARTUP_END)
+    generalConfig['FifoSize'] = parser.getint('General', 'FifoSize', fallback=256)
+    generalConfig['FifoPolicy'] = parser.get('General', 'FifoPolicy', fallback='drop-newest')
     # the startup dude processes their own
     if parser.has_section('Startup'):
         startupConfig = parser['Startup']
@@ -127,7 +129,9 @@ handler = SignalHandler(sel)
 # HSK HANDLER
 
 hsk = TurfHskHandler(sel,
-                     logName=LOG_NAME)
+                     logName=LOG_NAME,
+                     fifoSize=generalConfig['FifoSize'],
+                     fifoPolicy=generalConfig['FifoPolicy'])
 
 ###########################################################################
 
@@ -72,17 +72,12 @@ upstreams.append( SerHandler(sel,
 # see e.g. https://eev.ee/blog/2011/04/24/gotcha-python-scoping-closures/
 def makeUpstreamHandler(uph):
     def upstreamHandler(fd, mask):
-        if uph.fifo.empty():
-            logger.error("%s handler called but FIFO is empty?", uph.name)
-            raise IOError("empty fifo read")            
-        pktNo = os.read(fd, 1)
-        pkt = uph.fifo.get()
-        packetsForDownstream.put(pkt)
-        logger.info("got upstream packet #%d from %s via %s: %s",
-                    pktNo[0],
-                    hex(pkt[0]),
-                    uph.name,
-                    pkt.hex(sep=' '))
+        for pkt in uph.fifo.drain():
+            packetsForDownstream.put(pkt)
+            logger.info("got upstream packet from %s via %s: %s",
+                        hex(pkt[0]),
+                        uph.name,
+                        pkt.hex(sep=' '))
     return upstreamHandler
 
 # true serial downstreams
@@ -96,17 +91,12 @@ for i in range(4):
 # make a downstream handler factory function
 def makeDownstreamHandler(downh):
     def downstreamHandler(fd, mask):
-        if downh.fifo.empty():
-            logger.error("%s handler called but FIFO is empty?", downh.name)
-            return
-        pktNo = os.read(fd, 1)
-        pkt = downh.fifo.get()
-        packetsForUpstream.put(pkt)
-        logger.info("got downstream packet #%d from %s via %s: %s",
-                    pktNo[0],
-                    hex(pkt[0]),
-                    downh.name,
-                    pkt.hex(sep=' '))
+        for pkt in downh.fifo.drain():
+            packetsForUpstream.put(pkt)
+            logger.info("got downstream packet from %s via %s: %s",
+                        hex(pkt[0]),
+                        downh.name,
+                        pkt.hex(sep=' '))
     return downstreamHandler
 
 # start the upstreams
@@ -1,30 +1,31 @@
 from serial.threaded import Packetizer, ReaderThread
 from serial import Serial
-from cobs import cobs
+import hskframe
 import os
 import logging
 import traceback
 import threading
-import queue
 import selectors
+from eventqueue import EventQueue
 
 # this is basically copied from the SURF
 class TurfHskHandler:
     def __init__(self,
                  sel,
                  logName='testing',                 
-                 port='/dev/hskturf'):
+                 port='/dev/hskturf',
+                 fifoSize=256,
+                 fifoPolicy='drop-newest'):
         self.selector = sel
         self.logger = logging.getLogger(logName)
-        self.fifo = queue.Queue()
+        self.fifo = EventQueue(fifoSize, policy=fifoPolicy)
         self.port = Serial(port)
         self.handler = None
         self.transport = None
         self.myID = 0x60
         def thisFilter(pkt):
-            pktLen = len(pkt)
             rv = 0
-            if pktLen < 5 or pkt[3] != pktLen-5 or (sum(pkt[4:]) % 256):
+            if hskframe.check(pkt):
                 self.logger.info("Invalid packet: %s", pkt.hex(sep=' '))
                 rv = -1
             # packet is ok, now filter on my ID
@@ -50,7 +51,7 @@ class TurfHskHandler:
         self.sendPacket = self.handler.send_packet
         self.statistics = self.handler.statistics
         
-        self.selector.register(handler.rfd,
+        self.selector.register(self.fifo.rfd,
                                selectors.EVENT_READ,
                                callback)
 
@@ -66,18 +67,14 @@ class TurfHskHandler:
         raise RuntimeError("the housekeeping handler is not running")
 
     def dumpPacket(self, fd, mask):
-        """ print out the received packet from the fifo """
-        if self.fifo.empty():
-            self.logger.error("dump_packet called but FIFO is empty?")
-            return
-        pktno = os.read(fd, 1)
-        pkt = self.fifo.get()
-        self.logger.info("Pkt %d: %s", pktno[0], pkt.hex(sep=' '))
+        """ print out the received packets from the fifo """
+        for pkt in self.fifo.drain():
+            self.logger.info("Pkt: %s", pkt.hex(sep=' '))
             
         
-# sigh, reworked. we use a pipe to signal that our fifo should
-# be read. we push the received packet number % 255.
-# we also take the selector.
+# sigh, reworked. the fifo is an EventQueue, which signals
+# the selector through its own fd when there's something to read.
+# the selector side drains everything in one go.
 
 # This ONLY HANDLES COBS DECODING
 # filterFn handles checking if it's for us or if it has a checksum error
@@ -91,7 +88,6 @@ class TurfHskPacketHandler(Packetizer):
                  filterFn=_nullFilter
                  ):
         super(TurfHskPacketHandler, self).__init__()
-        self.rfd, self.wfd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)        
         self.fifo = fifo
         self.filterFn = filterFn
         
@@ -120,9 +116,8 @@ class TurfHskPacketHandler(Packetizer):
         """ implement the handle_packet function """
         if len(packet) == 0:
             return
-        try:
-            pkt = cobs.decode(packet)
-        except cobs.DecodeError:
+        pkt, skipped = hskframe.decode(packet)
+        if pkt is None:
             with self._statisticsLock:
                 self._errorPackets = self._errorPackets + 1
                 errorPackets = self._errorPackets
@@ -134,19 +129,15 @@ class TurfHskPacketHandler(Packetizer):
         filterResult = self.filterFn(pkt)
         self.logger.debug("got packet: filter result %d", filterResult)
         if filterResult == 0:
-            if not self.fifo.full():
-                with self._statisticsLock:
-                    curPkt = self._receivedPackets
+            dropped = self.fifo.put(pkt)
+            # with drop-oldest what got dropped was an older one, this one's in
+            queued = not dropped or self.fifo.policy == 'drop-oldest'
+            with self._statisticsLock:
+                if queued:
                     self._receivedPackets = self._receivedPackets + 1
-                self.fifo.put(pkt)
-                toWrite = (curPkt & 0xFF).to_bytes(1, 'little')
-                nb = os.write(self.wfd, toWrite)
-                if nb != 1:
-                    self.logger.error("could not write packet number %d to pipe!!!" % curPkt)
-            else:
-                with self._statisticsLock:
-                    self._droppedPackets = self._droppedPackets + 1
-                    droppedPackets = self._droppedPackets
+                self._droppedPackets = self._droppedPackets + dropped
+                droppedPackets = self._droppedPackets
+            if dropped:
                 self.logger.error("packet FIFO is full: dropped packet count %d" % droppedPackets)
         elif filterResult == 1:
             # not for us
@@ -161,7 +152,7 @@ class TurfHskPacketHandler(Packetizer):
 
     def send_packet(self, packet):
         """ send binary packet via COBS encoding """
-        d = cobs.encode(packet) + b'\x00'
+        d = hskframe.encode(packet)
         if self.transport:
             self.transport.write(d)
         with self._statisticsLock:
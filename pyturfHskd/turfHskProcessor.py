@@ -4,6 +4,7 @@ from subprocess import Popen, PIPE, TimeoutExpired
 from pathlib import Path
 import pickle
 import struct
+import hskframe
 from gpio import GPIO
 
 class TurfHskProcessor:
@@ -76,32 +77,41 @@ class TurfHskProcessor:
         rpkt.append(cks)
         self.hsk.sendPacket(rpkt)
 
+    # eye scan data is the scan, then its results, or just 0
+    # if there aren't any yet. None if no eye scan specified.
+    def eyeScanData(self, d):
+        if not len(d) or d[0] not in [0,1]:
+            return None
+        if d[0] == 0:
+            res = self.startup.gbe_scan.results()
+        else:
+            res = self.startup.aurora_scan.results()
+        # check to see if we have results yet
+        if res:
+            return bytes([d[0]]) + bytes(res)
+        # nope. just send back nothin'
+        return b'\x00'
+
     def eEyeScanResults(self, pkt):
         rpkt = bytearray(5)
         rpkt[1] = pkt[0]
         rpkt[0] = self.hsk.myID
         rpkt[2] = 20        
-        if not len(pkt) > 5 or pkt[4] not in [0,1]:
+        data = self.eyeScanData(pkt[4:-1])
+        if data is None:
             # no eye scan specified you get nothin'
             rpkt[3] = 0
             rpkt[4] = 0
+        elif len(data) > 255:
+            # doesn't fit, so it goes fragmented
+            for fpkt in self.fragments.start(pkt[0], 20, data):
+                self.hsk.sendPacket(fpkt)
+            return
         else:
-            if pkt[4] == 0:
-                res = self.startup.gbe_scan.results()
-            else:
-                res = self.startup.aurora_scan.results()
-            # check to see if we have results yet
-            if res:
-                rpkt[3] = len(res)+1
-                rpkt[4] = pkt[4]
-                rpkt += res
-                cks = (256 - sum(rpkt[4:])) & 0xFF
-                rpkt.append(cks)
-            else:
-                # nope. just send back nothin'
-                rpkt[3] = 1
-                rpkt[4] = 0
-                rpkt.append(0)
+            rpkt[3] = len(data)
+            rpkt[4:] = data
+            cks = (256 - sum(rpkt[4:])) & 0xFF
+            rpkt.append(cks)
         self.hsk.sendPacket(rpkt)
 
     def eStartState(self, pkt):
@@ -214,14 +224,7 @@ class TurfHskProcessor:
         rpkt[2] = 189
         d = pkt[4:-1]
         if len(d):
-            args = d.decode().split(' ')
-            cmd = [ "journalctl" ] + args
-            try:
-                p = Popen(cmd, stdin=PIPE, stdout=PIPE)
-                self.journal = p.communicate(timeout=5)[0]
-            except TimeoutExpired:
-                p.kill()
-                self.journal = p.communicate()[0]
+            self.journal = self._runJournal(d)
                 
         # all of this works even if journal is b''
         rd = self.journal[:255]
@@ -232,6 +235,51 @@ class TurfHskProcessor:
         rpkt.append(cks)
         self.hsk.sendPacket(rpkt)
 
+    @staticmethod
+    def _runJournal(d):
+        args = d.decode().split(' ')
+        cmd = [ "journalctl" ] + args
+        try:
+            p = Popen(cmd, stdin=PIPE, stdout=PIPE)
+            return p.communicate(timeout=5)[0]
+        except TimeoutExpired:
+            p.kill()
+            return p.communicate()[0]
+
+    # fragmented, you get all of it at once: either the output
+    # of a new query or whatever's left of the last one
+    def journalData(self, d):
+        if len(d):
+            return self._runJournal(d)
+        rd = self.journal
+        self.journal = b''
+        return rd
+
+    # fragmented transfers (see hskframe). An ack for fragment 0
+    # starts one for any command in bulkMap, the rest move it along.
+    def eFragmentAck(self, pkt):
+        a = hskframe.parseAck(pkt)
+        fpkts = None
+        if a is not None:
+            cmd, nextSeq, window, d = a
+            if nextSeq == 0 and cmd in self.bulkMap:
+                data = self.bulkMap[cmd](d)
+                if data is not None:
+                    fpkts = self.fragments.start(pkt[0], cmd, data, window)
+            elif nextSeq:
+                fpkts = self.fragments.send(pkt[0], cmd, nextSeq, window)
+        if fpkts is None:
+            rpkt = bytearray(5)
+            rpkt[1] = pkt[0]
+            rpkt[0] = self.hsk.myID
+            rpkt[2] = 0xFF
+            rpkt[3] = 0
+            rpkt[4] = 0
+            self.hsk.sendPacket(rpkt)
+            return
+        for fpkt in fpkts:
+            self.hsk.sendPacket(fpkt)
+
     # no reply, and only check length/magic no
     def eRestart(self, pkt):
         d = pkt[4:-1]
@@ -311,8 +359,15 @@ class TurfHskProcessor:
             135 : self.eSoftNext,
             189 : self.eJournal,            
             191 : self.eRestart,
-            203 : self.eCommandReset
+            203 : self.eCommandReset,
+            hskframe.kFragmentAckCmd : self.eFragmentAck
         }        
+        # commands that can go fragmented
+        self.bulkMap = {
+            20 : self.eyeScanData,
+            189 : self.journalData
+        }
+        self.fragments = hskframe.FragmentSender(hsk.myID)
         self.hsk = hsk
         self.zynq = zynq
         self.startup = startup
@@ -344,22 +399,18 @@ class TurfHskProcessor:
         return
         
     def basicHandler(self, fd, mask):
-        if self.hsk.fifo.empty():
-            self.logger.error("handler called but FIFO is empty?")
-            return
-        pktno = os.read(fd, 1)
-        pkt = self.hsk.fifo.get()
-        cmd = pkt[2]
-        if cmd in self.hskMap:
-            try:
-                cb = self.hskMap.get(cmd)
-                self.logger.debug("calling %s", cb.__name__)
-                cb(pkt)
-            except Exception as e:
-                import traceback
-                self.logger.error("exception %s thrown inside housekeeping handler?", repr(e))
-                self.logger.error(traceback.format_exc())
-                self.terminate()
-        else:
-            self.logger.info("ignoring unknown hsk command: %2.2x", cmd)
+        for pkt in self.hsk.fifo.drain():
+            cmd = pkt[2]
+            if cmd in self.hskMap:
+                try:
+                    cb = self.hskMap.get(cmd)
+                    self.logger.debug("calling %s", cb.__name__)
+                    cb(pkt)
+                except Exception as e:
+                    import traceback
+                    self.logger.error("exception %s thrown inside housekeeping handler?", repr(e))
+                    self.logger.error(traceback.format_exc())
+                    self.terminate()
+            else:
+                self.logger.info("ignoring unknown hsk command: %2.2x", cmd)
             